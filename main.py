@@ -5,23 +5,6 @@ from collections import OrderedDict
 from datetime import datetime
 from subprocess import check_call
 
-from PyQt4.QtGui import QApplication
-
-from spgr import (Read_ECoG_Recordings,
-                  Representative_Examples,
-                  Electrode_Locations,
-                  Spindle_Detection_Method,
-                  Single_Channel_Statistics,
-                  Cooccurrence_Histogram,
-                  Cooccurrence_of_Spindles,
-                  Cooccurrence_Percentile,
-                  Direction_of_Spindles,
-                  )
-
-
-from spgr.constants import LOG_PATH, LOGSRC_PATH, PROJECT
-from spgr.log import embed_images_in_html
-
 
 # ALWAYS GIT COMMIT
 all_func = OrderedDict([('-r', 'Read_ECoG_Recordings'),
@@ -45,17 +28,21 @@ parser.add_argument('--all', action='store_true',
 for abbr, func_name in all_func.items():
     parser.add_argument(abbr, help=func_name.replace('_', ' '),
                         action='store_true')
-args = parser.parse_args()
 
 
 if __name__ == '__main__':
+    # the processes which render the figures run this file again (without
+    # __main__), so the steps are imported only here
+    import spgr
+    from spgr.constants import LOG_PATH, LOGSRC_PATH, PROJECT
+    from spgr.log import embed_images_in_html
 
-    app = QApplication([])
+    args = parser.parse_args()
     t = datetime.now()
 
     for abbr, func_name in all_func.items():
         if args.all or getattr(args, abbr[1:]):
-            eval(func_name + '()')
+            getattr(spgr, func_name)()
 
     # PREPARE PANDOC FILE
     md_files = []
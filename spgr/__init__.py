@@ -1,10 +1,25 @@
-from .ecog_recordings import Read_ECoG_Recordings
-from .representative_examples import Representative_Examples
-from .electrode_locations import Electrode_Locations
-from .spindle_detection_method import Spindle_Detection_Method
-from .single_channel import Single_Channel_Statistics
-from .cooccurrence_of_spindles import (Cooccurrence_Histogram,
-                                       Cooccurrence_of_Spindles,
-                                       Cooccurrence_Percentile,
-                                       )
-from .spindle_direction import Direction_of_Spindles
+"""The steps of the analysis are imported only when they are used, so that
+importing one module (f.e. in the processes which render the figures) does
+not import R and all the other modules.
+"""
+from importlib import import_module
+
+STEPS = {'Read_ECoG_Recordings': 'ecog_recordings',
+         'Representative_Examples': 'representative_examples',
+         'Electrode_Locations': 'electrode_locations',
+         'Spindle_Detection_Method': 'spindle_detection_method',
+         'Single_Channel_Statistics': 'single_channel',
+         'Cooccurrence_Histogram': 'cooccurrence_of_spindles',
+         'Cooccurrence_of_Spindles': 'cooccurrence_of_spindles',
+         'Cooccurrence_Percentile': 'cooccurrence_of_spindles',
+         'Direction_of_Spindles': 'spindle_direction',
+         }
+
+__all__ = list(STEPS)
+
+
+def __getattr__(name):
+    if name not in STEPS:
+        raise AttributeError('module {} has no attribute {}'
+                             ''.format(__name__, name))
+    return getattr(import_module('.' + STEPS[name], __name__), name)
@@ -18,9 +18,11 @@ SCRIPTS_PATH = PROJECT_PATH.joinpath('scripts')
 DATA_PATH = PROJECT_PATH.joinpath('subjects')
 GROUP_PATH = PROJECT_PATH.joinpath('group')
 IMAGES_PATH = GROUP_PATH.joinpath('images')
+FIGURE_CACHE_PATH = IMAGES_PATH.joinpath('cache')  # delete to render again
 LOG_PATH = GROUP_PATH.joinpath('log')
 LOGSRC_PATH = LOG_PATH.joinpath('src')
 SCORES_PATH = GROUP_PATH.joinpath('scores')
+STATS_PATH = GROUP_PATH.joinpath('stats')
 
 PARAMETERS_PATH = SCRIPTS_PATH.joinpath(PROJECT).joinpath('parameters.json')
 with open(str(PARAMETERS_PATH), 'r') as f:
@@ -31,8 +33,12 @@ with open(str(PARAMETERS_PATH), 'r') as f:
 
 if not IMAGES_PATH.exists():
     IMAGES_PATH.mkdir(parents=True)
+if not FIGURE_CACHE_PATH.exists():
+    FIGURE_CACHE_PATH.mkdir(parents=True)
 if not LOGSRC_PATH.exists():
     LOGSRC_PATH.mkdir(parents=True)
+if not STATS_PATH.exists():
+    STATS_PATH.mkdir(parents=True)
 
 # READ DATA-------------------------------------------------------------------#
 REC_FOLDER = Path('rec')
@@ -113,26 +119,34 @@ ALL_REREF = ('avg', )
 
 # SPINDLE OPTIONS-------------------------------------------------------------#
 SPINDLE_FOLDER = Path('spindles')
+DIRECTION_FOLDER = Path('direction')
 SPINDLE_OPTIONS = PARAMETERS['SPINDLE_OPTIONS']
 SPINDLE_OPTIONS.update(DATA_OPTIONS)
 
 # SURFACE OPTIONS-------------------------------------------------------------#
 APARC_FOLDER = Path('aparc')
 PROJ_FOLDER = Path('proj')
+SURF_FOLDER = Path('surf')
 
 DEFAULT_HEMI = 'rh'
 SMOOTHING_STD = 10
 SMOOTHING_THRESHOLD = 20
+REGION_MAX_DIST = 5  # max distance (mm) between channel and labelled vertex
 FS_AVG = GROUP_PATH / 'fsaverage'
 MORPH_SMOOTHING = None
 
-fs = Freesurfer(str(FS_AVG))
-avg_surf = getattr(fs.read_brain(), DEFAULT_HEMI)
-avg_vert, _, avg_regions = fs.read_label(DEFAULT_HEMI,
-                                         parc_type=PARAMETERS['PARC_TYPE'])
+AVERAGE_BRAIN = ('fs', 'avg_surf', 'avg_vert', 'avg_regions')
 
 P_THRESHOLD = 0.05
 P_CORRECTION = 'fdr'
+LMER_BACKEND = 'R'  # 'R' (lme4) or 'numpy'
+# p-values passed to the maps: 'lmer' or 'permutation' (both are in the log).
+# The maps use them only if SATURATE_PVALUES is True.
+REGION_TEST = 'lmer'
+N_PERMUTATIONS = 10000
+PERM_CORRECTION = 'max'  # 'max' (max-statistic) or as P_CORRECTION
+N_BOOTSTRAP = 5000
+BOOTSTRAP_CI = .95
 
 # PLOT OPTIONS----------------------------------------------------------------#
 DPI = PARAMETERS['DPI']
@@ -154,18 +168,19 @@ COOCCUR_CHAN_LIMITS = {'avg': (3, 5.5),
                        }
 
 DIR_MAT_RATIO = 2 / 1
+DIR_MAT_PX = 320  # approximate size of the direction matrix, in pixels
 DIR_SURF_RATIO = 4 / 3
 DIR_SUMMARY_RATIO = 2 / 1
 DIR_SUMMARY_MINCNT = 100
 
 COLORMAP = PARAMETERS['COLORMAP']
 SATURATION_LEVEL = 0.4
+SATURATE_PVALUES = False  # desaturate regions which are not significant
 CHAN_COLOR = 0.8, 0.1, 0.1, 1.
 SKIN_COLOR = 0.93, 0.82, 0.81, 0.94
 NAN_COLOR = 0.2, 0.2, 0.2, 1.
 IMAGE_NAN_COLOR = 1., 1., 1., 1.
 HIGHLIGHT_COLOR = PARAMETERS['HIGHLIGHT_COLOR']  # color to highlight spindles
-HIGHLIGHT_HEIGHT = 200
 SURF_PLOT_SIZE = 50, 35
 REPR_PLOT_SIZE = 10, 8
 SINGLE_SUBJ_SURF = 20, 15
@@ -176,6 +191,27 @@ HIST_FIG_SIZE = 40, 30  # actual size in mm for figure
 TICKS_FONT_SIZE = 8
 LABEL_FONT_SIZE = 10
 
+RENDER_APP = 'osmesa'  # offscreen software rendering, no Qt
+RENDER_WORKERS = None  # processes to render figures (None: all the cores)
+
 CENTER = (25, -15, 18)
 ELEVATION = -6
 AZIMUTH = 96
+
+
+def __getattr__(name):
+    """Read the average brain (fs, avg_surf, avg_vert, avg_regions) the first
+    time that it is used, so that the processes which do not need it (such as
+    the ones rendering the figures of single subjects) do not read it."""
+    if name not in AVERAGE_BRAIN:
+        raise AttributeError('module {} has no attribute {}'
+                             ''.format(__name__, name))
+
+    fs = Freesurfer(str(FS_AVG))
+    avg_vert, _, avg_regions = fs.read_label(DEFAULT_HEMI,
+                                             parc_type=PARAMETERS['PARC_TYPE'])
+    globals().update(fs=fs,
+                     avg_surf=getattr(fs.read_brain(), DEFAULT_HEMI),
+                     avg_vert=avg_vert,
+                     avg_regions=avg_regions)
+    return globals()[name]
@@ -1,5 +1,4 @@
 from numpy import max, mean, min
-from pickle import Pickler, Unpickler
 
 from .constants import (ALL_REREF,
                         COOCCUR_CHAN_LIMITS,
@@ -8,11 +7,14 @@ from .constants import (ALL_REREF,
                         PARAMETERS,
                         P_CORRECTION,
                         P_THRESHOLD,
+                        REGION_TEST,
                         SURF_PLOT_SIZE)
-from .lmer_stats import add_to_dataframe, lmer
+from .lmer_stats import ElectrodeFrame, compare_backends, lmer
 from .plot_spindles import plot_lmer
 from .plot_histogram import make_hist_overlap
-from .spindle_source import get_chan_with_regions
+from .render import FigureQueue
+from .resampling import region_permutation, report_permutation
+from .spindle_source import get_region_codes
 from .stats_on_spindles import (count_cooccur_per_chan,
                                 get_cooccur_percent,
                                 print_table_percent)
@@ -25,6 +27,7 @@ def Cooccurrence_Histogram(lg, images_dir):
 
     lg.info('## Histogram of Co-occurrence of Spindles')
 
+    figures = FigureQueue()
     for reref in ALL_REREF:
         lg.info('### reref {}'.format(reref))
 
@@ -38,19 +41,22 @@ def Cooccurrence_Histogram(lg, images_dir):
 
             png_file = str(images_dir.joinpath('hist_{}_{}.png'.format(reref,
                                                subj)))
-            v.save(png_file)
+            figures.submit(v, png_file)
             lg.info('![{}]({})'.format('{} {}'.format(reref, subj), png_file))
 
         lg.info('Average number of channels with co-occurring spindles:'
                 'mean {: 6.2f}, range {: 6.2f} - {: 6.2f}'
                 ''.format(mean(all_p), min(all_p), max(all_p)))
 
+    figures.run()
+
 
 @with_log
 def Cooccurrence_of_Spindles(lg, images_dir):
 
     lg.info('## Cooccurrence_of_Spindles')
 
+    figures = FigureQueue()
     for reref in ALL_REREF:
 
         limits = COOCCUR_CHAN_LIMITS[reref]
@@ -58,36 +64,43 @@ def Cooccurrence_of_Spindles(lg, images_dir):
         lg.info('### reref {}'.format(reref))
 
         dataframe_file = GROUP_PATH / ('dataframe_' + reref + '_' +
-                                       PARAMETERS['summarize_cooccur'] + '.pkl')
+                                       PARAMETERS['summarize_cooccur'] + '.npz')
 
         if dataframe_file.exists():
-            with dataframe_file.open('rb') as f:
-                dataframe = Unpickler(f).load()
+            dataframe = ElectrodeFrame.load(dataframe_file)
         else:
 
-            dataframe = {'subj': [], 'region': [], 'elec': [], 'value': []}
+            dataframe = ElectrodeFrame()
 
             for subj in HEMI_SUBJ:
                 chan_val = count_cooccur_per_chan(subj, reref,
                                                   PARAMETERS['summarize_cooccur'])
-                chan = get_chan_with_regions(subj, reref)
-                add_to_dataframe(dataframe, subj, chan_val, chan)
+                region_codes = get_region_codes(subj, reref)
+                dataframe.add(subj, chan_val, region_codes)
 
-            with dataframe_file.open('wb') as f:
-                Pickler(f).dump(dataframe)
+            dataframe.save(dataframe_file)
 
         lg.info('\nCorrected at {} {}'.format(P_CORRECTION, P_THRESHOLD))
         coef, pvalues = lmer(dataframe, lg, adjust=P_CORRECTION,
                              pvalue=P_THRESHOLD)
+        compare_backends(dataframe, lg, adjust=P_CORRECTION)
+
+        tstat, perm_pvalues = region_permutation(dataframe, 'value')
+        report_permutation(lg, tstat, perm_pvalues, P_THRESHOLD)
+        if REGION_TEST == 'permutation':
+            pvalues = perm_pvalues
+
         coef['insula_2'] = coef['middletemporal_2']  # insula has only 2 datapoints
         v = plot_lmer(coef, pvalues=pvalues, limits=limits,
                       size_mm=SURF_PLOT_SIZE)
         png_name = 'cooccurrence_map_{}.png'.format(reref)
         png_file = str(images_dir.joinpath(png_name))
-        v.save(png_file)
+        figures.submit(v, png_file)
         lg.info('![{}]({})'.format('{}'.format(reref),
                 png_file))
 
+    figures.run()
+
 
 @with_log
 def Cooccurrence_Percentile(lg, images_dir):
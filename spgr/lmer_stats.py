@@ -1,36 +1,263 @@
-from numpy import diag, ones, r_
+from functools import lru_cache
+from hashlib import md5
+from importlib.util import find_spec
+from logging import getLogger
+from re import match
+
+from numpy import (abs,
+                   arange,
+                   argsort,
+                   array,
+                   asarray,
+                   concatenate,
+                   diag,
+                   empty,
+                   eye,
+                   full,
+                   isfinite,
+                   load,
+                   nanmax,
+                   ones,
+                   r_,
+                   savez,
+                   stack)
+
+from .constants import LMER_BACKEND
+from .mixed_model import contrast_pvalues, fit_random_intercept
+from .stats_cache import cached_stats
+
+lg = getLogger(__name__)
+
+HAS_R = find_spec('rpy2') is not None
+if not HAS_R:
+    lg.info('Could not import rpy2, using native mixed-effects models only')
+
+FORMULA_RANDOM_INTERCEPT = (r'^\s*(\w+)\s*~\s*0\s*\+\s*(\w+)\s*\+\s*'
+                            r'\(\s*1\s*\|\s*(\w+)\s*\)\s*$')
+CATEGORICAL = ('subj', 'region', 'elec')
+
+
+class ElectrodeFrame:
+    """Table with one row for each electrode, stored by column.
+
+    The columns 'subj', 'region' and 'elec' are categorical: they are stored as
+    integer codes, with the names stored only once. All the other columns are
+    float.
 
-from rpy2 import robjects
-from rpy2.robjects.numpy2ri import activate
-from rpy2.robjects.packages import importr
-
-
-activate()
-lme4 = importr('lme4')
-multcomp = importr('multcomp')
-
-
-def add_to_dataframe(df, subj, values, chan):
-    """Add values for each electrode to the main frame.
+    Parameters
+    ----------
+    columns : tuple of str
+        names of the columns with values
     """
-    for i, one_chan in enumerate(chan.chan):
-        one_value = values[i]
-        region = one_chan.attr['region']
-        if region[:3] == 'ctx':
-            df['subj'].append(subj)
-            df['region'].append(region[7:])
-            df['elec'].append(one_chan.label)
-            df['value'].append(one_value)
+    def __init__(self, columns=('value', )):
+        self.columns = tuple(columns)
+        self._names = {k: {} for k in CATEGORICAL}
+        self._chunks = {k: [] for k in CATEGORICAL + self.columns}
+        self._data = None
+
+    def __len__(self):
+        return len(self['subj'])
+
+    def __getitem__(self, column):
+        """Integer codes for categorical columns, values for the others."""
+        if self._data is None:
+            self._data = {}
+            for k, chunks in self._chunks.items():
+                if k in CATEGORICAL:
+                    self._data[k] = concatenate([array([], dtype=int), ] +
+                                                chunks)
+                else:
+                    self._data[k] = concatenate([array([]), ] + chunks)
+        return self._data[column]
+
+    def add(self, subj, values, region_codes):
+        """Add the values of all the electrodes of one subject.
+
+        Parameters
+        ----------
+        subj : str
+            subject code
+        values : ndarray or dict
+            one value for each channel (for the column 'value'), or dict where
+            each key is one column and each value has one value for each
+            channel
+        region_codes : tuple of (ndarray, ndarray, tuple)
+            labels, region index and regions of the channels, as returned by
+            get_region_codes. Only channels in a region are added.
+        """
+        if not isinstance(values, dict):
+            values = {'value': values}
+
+        labels, codes, regions = region_codes
+        in_region = codes >= 0
+
+        region_idx = array([self._code('region', x) for x in regions],
+                           dtype=int)
+        self._chunks['subj'].append(full(in_region.sum(),
+                                         self._code('subj', subj), dtype=int))
+        self._chunks['region'].append(region_idx[codes[in_region]])
+        self._chunks['elec'].append(array([self._code('elec', x)
+                                           for x in labels[in_region]],
+                                          dtype=int))
+        for column in self.columns:
+            one_values = asarray(values[column], dtype=float)
+            self._chunks[column].append(one_values[in_region])
+
+        self._data = None
+
+    def categories(self, column):
+        """Return the codes and the names of a categorical column, where the
+        names are sorted alphabetically.
+
+        Parameters
+        ----------
+        column : str
+            'subj', 'region' or 'elec'
+
+        Returns
+        -------
+        ndarray of int
+            for each row, index of its name
+        list of str
+            sorted names
+        """
+        names = list(self._names[column])
+        i_sort = argsort(names)
+        new_code = empty(len(names), dtype=int)
+        new_code[i_sort] = arange(len(names))
+
+        return new_code[self[column]], [names[i] for i in i_sort]
+
+    def to_dict(self):
+        """Convert to dict where each key is one column (with names for the
+        categorical columns)."""
+        df = {}
+        for k in CATEGORICAL:
+            codes, names = self.categories(k)
+            df[k] = [names[i] for i in codes]
+        for k in self.columns:
+            df[k] = self[k].tolist()
+        return df
+
+    def to_r(self):
+        """Convert to robjects.DataFrame, with factors for the categorical
+        columns. Each column is converted in one step."""
+        robjects = _import_r()[0]
+        d_conv = {}
+        for k in CATEGORICAL:
+            codes, names = self.categories(k)
+            factor = robjects.IntVector(codes + 1)
+            factor.do_slot_assign('levels', robjects.StrVector(names))
+            factor.do_slot_assign('class', robjects.StrVector(['factor', ]))
+            d_conv[k] = factor
+        for k in self.columns:
+            d_conv[k] = robjects.FloatVector(self[k])
+
+        return robjects.DataFrame(d_conv)
+
+    def save(self, filename):
+        """Store the table in binary format (numpy .npz).
+
+        Parameters
+        ----------
+        filename : path to file
+            file to write to
+        """
+        arrays = {}
+        for k in CATEGORICAL:
+            arrays[k] = self[k].astype('int32')
+            arrays['names_' + k] = array(list(self._names[k]), dtype=str)
+        for k in self.columns:
+            arrays['value_' + k] = self[k]
+
+        with open(str(filename), 'wb') as f:
+            savez(f, **arrays)
+
+    @classmethod
+    def load(cls, filename):
+        """Read the table stored with save.
+
+        Parameters
+        ----------
+        filename : path to file
+            file to read from
+
+        Returns
+        -------
+        instance of ElectrodeFrame
+            the table
+        """
+        with load(str(filename)) as arrays:
+            columns = [k[len('value_'):] for k in arrays.files
+                       if k.startswith('value_')]
+            frame = cls(columns)
+            for k in CATEGORICAL:
+                frame._names[k] = {str(name): i for i, name
+                                   in enumerate(arrays['names_' + k])}
+                frame._chunks[k] = [arrays[k].astype(int), ]
+            for k in columns:
+                frame._chunks[k] = [arrays['value_' + k], ]
+
+        return frame
+
+    @classmethod
+    def from_dict(cls, df):
+        """Create table from dict where each key is one column.
+
+        Parameters
+        ----------
+        df : dict
+            dict where each key is one column, with 'subj', 'region' and
+            'elec' as str and the other columns as numbers
+
+        Returns
+        -------
+        instance of ElectrodeFrame
+            the table
+        """
+        columns = [k for k in df if k not in CATEGORICAL]
+        frame = cls(columns)
+        for k in CATEGORICAL:
+            frame._chunks[k] = [array([frame._code(k, x) for x in df[k]],
+                                      dtype=int), ]
+        for k in columns:
+            frame._chunks[k] = [asarray(df[k], dtype=float), ]
+
+        return frame
+
+    def hash(self):
+        """Hash of the content of the table, which does not depend on the
+        order in which the names were added.
+
+        Returns
+        -------
+        str
+            md5 hexdigest
+        """
+        h = md5()
+        for k in CATEGORICAL:
+            codes, names = self.categories(k)
+            h.update('\0'.join(names).encode())
+            h.update(codes.astype('int64').tobytes())
+        for k in self.columns:
+            h.update(k.encode())
+            h.update(self[k].tobytes())
+        return h.hexdigest()
+
+    def _code(self, column, name):
+        """Integer code for one name in a categorical column."""
+        return self._names[column].setdefault(str(name),
+                                              len(self._names[column]))
 
 
 def lmer(df_raw, lg, formula='value ~ 0 + region + (1|subj)', adjust='fdr',
-         pvalue=0.05):
-    """Compute linear mixed-effects models, using R
+         pvalue=0.05, backend=LMER_BACKEND):
+    """Compute linear mixed-effects models, using R or numpy
 
     Parameters
     ----------
-    df_raw : dict
-        dict where each key is one column
+    df_raw : instance of ElectrodeFrame or dict
+        table with the values (or dict where each key is one column)
     lg : instance of logging.Logger
         logging template
     formula : str
@@ -39,6 +266,9 @@ def lmer(df_raw, lg, formula='value ~ 0 + region + (1|subj)', adjust='fdr',
         adjustment ('fdr')
     pvalue : float
         threshold for p-value to report the result.
+    backend : str
+        'R' (lme4 and multcomp) or 'numpy' (only for formulas such as
+        'value ~ 0 + region + (1|subj)')
 
     Returns
     -------
@@ -47,24 +277,227 @@ def lmer(df_raw, lg, formula='value ~ 0 + region + (1|subj)', adjust='fdr',
     dict
         dictionary with pvalues
     """
-    single_regions = sorted(set(df_raw['region']))
+    response, rhs = formula.split('~')
+    response = response.strip()
+    fit = lmer_batch(df_raw, (response, ), '~' + rhs, adjust, backend)
+
+    coef, pvalues, intercept = fit[response]
+    report_values(lg, coef, pvalues, intercept, pvalue)
+
+    return coef, pvalues
+
+
+def lmer_batch(df_raw, responses, formula='~ 0 + region + (1|subj)',
+               adjust='fdr', backend=LMER_BACKEND):
+    """Compute linear mixed-effects models for many responses, which share the
+    same design (such as subj, region, elec).
+
+    Parameters
+    ----------
+    df_raw : instance of ElectrodeFrame or dict
+        table with the values (or dict where each key is one column)
+    responses : list of str
+        columns in df_raw to use as response, one model for each
+    formula : str
+        right-hand side of the formula to test
+    adjust : str
+        adjustment ('fdr')
+    backend : str
+        'R' (lme4 and multcomp) or 'numpy' (only for formulas such as
+        '~ 0 + region + (1|subj)')
+
+    Returns
+    -------
+    dict
+        for each response, a tuple with the dictionary with coefficients, the
+        dictionary with pvalues and the value for the intercept
+
+    Notes
+    -----
+    The design and the contrasts are prepared once for all the responses. In
+    R, the dataframe is converted only once.
+    """
+    if isinstance(df_raw, dict):
+        df_raw = ElectrodeFrame.from_dict(df_raw)
+
+    if backend == 'R' and not HAS_R:
+        lg.debug('R is not available, using numpy for lmer')
+        backend = 'numpy'
+
+    if backend == 'R':
+        compute = _lmer_r
+    elif backend == 'numpy':
+        compute = _lmer_numpy
+    else:
+        raise ValueError('Unknown backend ' + backend)
+
+    contr = _contrast_matrix(len(df_raw.categories('region')[1]))
+    key = ('lmer', df_raw.hash(), tuple(responses), formula, contr, adjust,
+           backend)
+    fit = cached_stats(key, compute, df_raw, responses, formula, adjust)
+
+    return {response: (coef, pvalues, intercept)
+            for response, (coef, intercept, pvalues) in zip(responses, fit)}
+
+
+def compare_backends(df_raw, lg, responses=('value', ),
+                     formula='~ 0 + region + (1|subj)', adjust='fdr'):
+    """Compare the results of lme4 and of the numpy implementation.
+
+    Parameters
+    ----------
+    df_raw : instance of ElectrodeFrame or dict
+        table with the values (or dict where each key is one column)
+    lg : instance of logging.Logger
+        logging template
+    responses : list of str
+        columns in df_raw to use as response, one model for each
+    formula : str
+        right-hand side of the formula to test
+    adjust : str
+        adjustment ('fdr')
+
+    Returns
+    -------
+    float
+        max absolute difference between the coefficients (None if R is not
+        available)
+    float
+        max absolute difference between the pvalues (None if R is not
+        available)
+
+    Notes
+    -----
+    Both fits go through lmer_batch, so they are read from the stats cache
+    when the same model was already computed with that backend.
+    """
+    if not HAS_R:
+        lg.info('R is not available, lme4 and numpy cannot be compared')
+        return None, None
+
+    fit_r = lmer_batch(df_raw, responses, formula, adjust, backend='R')
+    fit_np = lmer_batch(df_raw, responses, formula, adjust, backend='numpy')
+
+    diff_coef = diff_intercept = diff_pvalues = 0
+    for response in responses:
+        coef_r, pvalues_r, intercept_r = fit_r[response]
+        coef_np, pvalues_np, intercept_np = fit_np[response]
+
+        regions = sorted(coef_r)
+        diff_coef = nanmax(r_[diff_coef, [abs(coef_r[k] - coef_np[k])
+                                          for k in regions]])
+        diff_pvalues = nanmax(r_[diff_pvalues,
+                                 [abs(pvalues_r[k] - pvalues_np[k])
+                                  for k in regions]])
+        diff_intercept = max(diff_intercept, abs(intercept_r - intercept_np))
+
+    lg.info('lme4 vs numpy: max difference coef={:.2e} (intercept {:.2e}), '
+            'p-values={:.2e}'.format(diff_coef, diff_intercept, diff_pvalues))
+
+    return diff_coef, diff_pvalues
 
-    formula = robjects.Formula(formula)
-    adjustment = multcomp.adjusted(adjust)
 
+@lru_cache(maxsize=None)
+def _import_r():
+    """Start R and load lme4 and multcomp, only the first time that they are
+    used (so that the results read from the stats cache do not need R).
+
+    Returns
+    -------
+    module
+        rpy2.robjects
+    instance of rpy2.robjects.packages.Package
+        lme4
+    instance of rpy2.robjects.packages.Package
+        multcomp
+    """
+    from rpy2 import robjects
+    from rpy2.robjects.numpy2ri import activate
+    from rpy2.robjects.packages import importr
+
+    activate()
+    return robjects, importr('lme4'), importr('multcomp')
+
+
+def _lmer_r(df_raw, responses, formula, adjust):
+    """Compute linear mixed-effects models with lme4 and multcomp in R.
+
+    Returns
+    -------
+    list of tuple
+        for each response, the dictionary with coefficients, the value for the
+        intercept and the dictionary with pvalues
+    """
+    robjects, lme4, multcomp = _import_r()
+    single_regions = df_raw.categories('region')[1]
+
+    adjustment = multcomp.adjusted(adjust)
     contr = _create_contrasts(single_regions)
+    data = df_raw.to_r()
 
-    lm1 = lme4.lmer(formula, data=DataFrame(df_raw))
-    comps = multcomp.glht(lm1, contr)
-    summary = multcomp.summary_glht(comps, test=adjustment)
+    fit = []
+    for response in responses:
+        lm1 = lme4.lmer(robjects.Formula(response + ' ' + formula), data=data)
+        comps = multcomp.glht(lm1, contr)
+        summary = multcomp.summary_glht(comps, test=adjustment)
+        fit.append(_get_coef_pvalue(summary))
 
-    coef, intercept, pvalues = _get_coef_pvalue(summary)
-    _report_values(lg, coef, pvalues, intercept, pvalue)
+    return fit
 
-    return coef, pvalues
 
+def _lmer_numpy(df_raw, responses, formula, adjust):
+    """Compute linear mixed-effects models with one random intercept in numpy.
+
+    Returns
+    -------
+    list of tuple
+        for each response, the dictionary with coefficients, the value for the
+        intercept and the dictionary with pvalues
+    """
+    terms = match(FORMULA_RANDOM_INTERCEPT, 'y ' + formula)
+    if terms is None:
+        raise ValueError('numpy backend only supports formulas such as '
+                         '"~ 0 + region + (1|subj)", not ' + formula)
+    _, fixed, random = terms.groups()
+
+    fixed_codes, levels = df_raw.categories(fixed)
+    group = df_raw.categories(random)[0]
+    y = stack([df_raw[response] for response in responses], axis=1)
+
+    # rows with NaN are omitted (like na.omit in R), responses with the same
+    # rows are fitted together
+    is_valid = isfinite(y)
+    same_rows = {}
+    for i, one_valid in enumerate(is_valid.T):
+        same_rows.setdefault(one_valid.tobytes(), []).append(i)
+
+    beta = empty((len(responses), len(levels)))
+    cov_beta = empty((len(responses), len(levels), len(levels)))
+    for i_resp in same_rows.values():
+        rows = is_valid[:, i_resp[0]]
+        x = eye(len(levels))[fixed_codes[rows]]
+        beta[i_resp], cov_beta[i_resp], _, _ = fit_random_intercept(
+            x, group[rows], y[rows][:, i_resp])
+
+    contr = _contrast_matrix(len(levels))
+
+    fit = []
+    for one_beta, one_cov in zip(beta, cov_beta):
+        estimate, pvalues = contrast_pvalues(one_beta, one_cov, contr, adjust)
+
+        coefficients = dict(zip(['intercept', ] + levels, estimate))
+        intercept = coefficients['intercept']
+        coefficients = _add_intercept(coefficients)
+
+        pvalues = dict(zip(['intercept', ] + levels, pvalues))
+        pvalues.pop('intercept')
+
+        fit.append((coefficients, intercept, pvalues))
 
-def _report_values(lg, coef, pvalues, intercept, p_threshold):
+    return fit
+
+
+def report_values(lg, coef, pvalues, intercept, p_threshold):
     """Report values of the LMER statistics, including the intercept value
 
     Parameters
@@ -110,17 +543,33 @@ def _create_contrasts(regions):
         use this to compute the intercept as well as the other contrasts (maybe
         one too many).
     """
-    n_regions = len(regions)
+    robjects = _import_r()[0]
+    fx = robjects.Matrix(_contrast_matrix(len(regions)))
+    rownames = ['intercept', ] + regions
+    fx.rownames = robjects.StrVector(rownames)
+
+    return fx
+
 
+def _contrast_matrix(n_regions):
+    """Create the matrix with the contrasts: the first row is the mean of all
+    the regions, then each region against the mean of the other regions.
+
+    Parameters
+    ----------
+    n_regions : int
+        number of regions
+
+    Returns
+    -------
+    ndarray
+        matrix with the contrasts, with size (n_regions+1) X n_regions.
+    """
     x = diag(ones(n_regions))
     x[x == 0] = -1 / (n_regions - 1)
     x = r_[ones((1, n_regions)) * 1 / n_regions, x]
 
-    fx = robjects.Matrix(x)
-    rownames = ['intercept', ] + regions
-    fx.rownames = robjects.StrVector(rownames)
-
-    return fx
+    return x
 
 
 def _get_coef_pvalue(summary):
@@ -172,23 +621,3 @@ def _add_intercept(coeff):
     for k, v in coeff.items():
         coeff[k] = intercept + v
     return coeff
-
-
-class DataFrame(robjects.DataFrame):
-    """Dataframe to convert dictionary into robjections.Dataframe
-
-    Parameters
-    ----------
-    d : dict
-        dictionary with values as float or str
-    """
-    def __init__(self, d):
-        d_conv = {}
-        for key, values in d.items():
-            if isinstance(values[0], str):
-                d_conv[key] = robjects.StrVector(values)
-            elif isinstance(values[0], float) or isinstance(values[0], int):
-                # very unlucky if first value is NaN or numpy
-                d_conv[key] = robjects.FloatVector(values)
-
-        super().__init__(d_conv)
@@ -0,0 +1,220 @@
+"""Linear mixed-effects models with one random intercept, only with numpy and
+scipy. This is the same model as lme4::lmer(y ~ 0 + x + (1|group)), fitted
+with REML.
+"""
+from numpy import (abs,
+                   arange,
+                   argsort,
+                   asarray,
+                   bincount,
+                   diag,
+                   dot,
+                   empty,
+                   isnan,
+                   log,
+                   maximum,
+                   minimum,
+                   nan,
+                   sqrt,
+                   zeros)
+from numpy.linalg import inv, slogdet, solve
+from scipy.optimize import minimize_scalar
+from scipy.stats import norm
+
+
+THETA_MAX = 100  # max ratio between std of random intercept and residuals
+
+
+def fit_random_intercept(x, group, y):
+    """Fit a linear mixed-effects model with a random intercept for each
+    group, using restricted maximum likelihood (REML).
+
+    Parameters
+    ----------
+    x : ndarray
+        n_obs X n_fixed matrix with the fixed effects
+    group : ndarray of int
+        for each observation, index of its group (0, 1, 2, ...)
+    y : ndarray
+        response for each observation (n_obs), or n_obs X n_responses matrix
+        to fit one model for each response, with the same design.
+
+    Returns
+    -------
+    ndarray
+        estimates of the fixed effects (n_fixed, or n_responses X n_fixed)
+    ndarray
+        n_fixed X n_fixed covariance matrix of the estimates (or
+        n_responses X n_fixed X n_fixed)
+    float or ndarray
+        std of the random intercept
+    float or ndarray
+        std of the residuals
+
+    Notes
+    -----
+    The covariance of the observations in one group is
+    sigma2 * (I + gamma * J), so its inverse has a closed form and the
+    likelihood only depends on the sums within each group. The REML criterion
+    is minimized for theta = sqrt(gamma), like in lme4, and sigma2 is profiled
+    out.
+
+    The sums that depend only on the design (x and group) are computed once
+    for all the responses. Each response only needs a one-dimensional
+    optimization on matrices of size n_fixed X n_fixed.
+    """
+    x = asarray(x, dtype=float)
+    y = asarray(y, dtype=float)
+    one_response = y.ndim == 1
+    if one_response:
+        y = y[:, None]
+
+    n_per_group = bincount(group)
+    x_group = _sum_per_group(x, group)  # n_groups X n_fixed
+    xx = dot(x.T, x)
+
+    y_group = _sum_per_group(y, group)  # n_groups X n_responses
+    xy = dot(x.T, y)
+    yy = (y ** 2).sum(axis=0)
+
+    out = [_fit_one_response(x.shape, n_per_group, x_group, xx,
+                             y_group[:, i], xy[:, i], yy[i])
+           for i in range(y.shape[1])]
+    beta, cov_beta, sd_group, sd_resid = [asarray(v) for v in zip(*out)]
+
+    if one_response:
+        return beta[0], cov_beta[0], sd_group[0], sd_resid[0]
+    else:
+        return beta, cov_beta, sd_group, sd_resid
+
+
+def _fit_one_response(x_shape, n_per_group, x_group, xx, y_group, xy, yy):
+    """Find the REML solution for one response, based on the sums of the
+    design and of the response.
+
+    Returns
+    -------
+    ndarray
+        estimates of the fixed effects
+    ndarray
+        n_fixed X n_fixed covariance matrix of the estimates
+    float
+        std of the random intercept
+    float
+        std of the residuals
+    """
+    n_obs, n_fixed = x_shape
+
+    def _solve(theta):
+        w = theta ** 2 / (1 + n_per_group * theta ** 2)
+        a = xx - dot(x_group.T * w, x_group)
+        b = xy - dot(x_group.T * w, y_group)
+        beta = solve(a, b)
+        sigma2 = (yy - dot(y_group * w, y_group) - dot(beta, b))
+        sigma2 /= (n_obs - n_fixed)
+        return beta, a, sigma2
+
+    def _reml(theta):
+        _, a, sigma2 = _solve(theta)
+        return ((n_obs - n_fixed) * log(sigma2) +
+                log(1 + n_per_group * theta ** 2).sum() +
+                slogdet(a)[1])
+
+    opt = minimize_scalar(_reml, bounds=(0, THETA_MAX), method='bounded',
+                          options={'xatol': 1e-8})
+    theta = opt.x
+    if _reml(0) <= opt.fun:  # singular fit, on the boundary
+        theta = 0
+
+    beta, a, sigma2 = _solve(theta)
+    cov_beta = sigma2 * inv(a)
+
+    return beta, cov_beta, theta * sqrt(sigma2), sqrt(sigma2)
+
+
+def contrast_pvalues(beta, cov_beta, contrasts, adjust='fdr'):
+    """Test linear combinations of the fixed effects, with z-tests (like
+    multcomp::glht on a lmer model).
+
+    Parameters
+    ----------
+    beta : ndarray
+        estimates of the fixed effects
+    cov_beta : ndarray
+        covariance matrix of the estimates
+    contrasts : ndarray
+        n_contrasts X n_fixed matrix
+    adjust : str
+        adjustment for multiple comparisons (see p_adjust)
+
+    Returns
+    -------
+    ndarray
+        estimate of each contrast
+    ndarray
+        adjusted p-value of each contrast
+    """
+    estimate = dot(contrasts, beta)
+    se = sqrt(diag(dot(dot(contrasts, cov_beta), contrasts.T)))
+    pvalues = 2 * norm.sf(abs(estimate / se))
+
+    return estimate, p_adjust(pvalues, adjust)
+
+
+def p_adjust(pvalues, method='fdr'):
+    """Adjust p-values for multiple comparisons, like p.adjust in R.
+
+    Parameters
+    ----------
+    pvalues : ndarray
+        uncorrected p-values (NaN values are ignored)
+    method : str
+        'fdr' (or 'BH', Benjamini & Hochberg), 'holm', 'bonferroni' or 'none'
+
+    Returns
+    -------
+    ndarray
+        adjusted p-values
+    """
+    pvalues = asarray(pvalues, dtype=float)
+    adjusted = empty(pvalues.shape)
+    adjusted.fill(nan)
+
+    is_valid = ~isnan(pvalues)
+    p = pvalues[is_valid]
+    n = len(p)
+
+    if method in ('fdr', 'BH'):
+        i_sort = argsort(p)[::-1]
+        p_sorted = n / arange(n, 0, -1) * p[i_sort]
+        p_sorted = minimum.accumulate(p_sorted)
+    elif method == 'holm':
+        i_sort = argsort(p)
+        p_sorted = (n - arange(n)) * p[i_sort]
+        p_sorted = maximum.accumulate(p_sorted)
+    elif method == 'bonferroni':
+        i_sort = arange(n)
+        p_sorted = n * p
+    elif method == 'none':
+        i_sort = arange(n)
+        p_sorted = p
+    else:
+        raise ValueError('Unknown adjustment method ' + method)
+
+    p_adj = zeros(n)
+    p_adj[i_sort] = minimum(1, p_sorted)
+    adjusted[is_valid] = p_adj
+
+    return adjusted
+
+
+def _sum_per_group(x, group):
+    """Sum the rows of x (1d or 2d) within each group."""
+    if x.ndim == 1:
+        return bincount(group, weights=x)
+
+    x_group = zeros((group.max() + 1, x.shape[1]))
+    for i in range(x.shape[1]):
+        x_group[:, i] = bincount(group, weights=x[:, i],
+                                 minlength=x_group.shape[0])
+    return x_group
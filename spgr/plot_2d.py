@@ -0,0 +1,178 @@
+"""Figures in 2D (histograms, traces and matrices), drawn without OpenGL.
+
+The figures are described by objects which are drawn only when saved (with
+the Agg raster backend of matplotlib), so they can be sent to FigureQueue.
+"""
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import PolyCollection
+from matplotlib.figure import Figure
+from matplotlib.ticker import MultipleLocator
+from numpy import asarray, clip, isnan, repeat, stack, uint8, zeros
+from vispy.color import get_colormap
+
+from .constants import DPI, TICKS_FONT_SIZE
+
+
+class HistogramFigure:
+    """Histogram, where all the bars are drawn as one collection.
+
+    Parameters
+    ----------
+    heights : ndarray
+        height of each bar (empty bars are not drawn)
+    bin_edges : ndarray
+        edges of the bars (one more than heights)
+    size_mm : tuple of 2 int
+        size in mm of the final image
+    x_lim, y_lim : tuple of 2 float
+        limits of the axes
+    x_ticks, y_ticks : tuple of 2 float
+        distance between major and minor ticks
+    color : str or tuple
+        color of the bars
+    border_width : float
+        width of the border of the bars, in pixels
+    """
+    def __init__(self, heights, bin_edges, size_mm, x_lim, y_lim,
+                 x_ticks=(10, 1), y_ticks=(10, 1), color='w',
+                 border_width=1):
+        self.heights = asarray(heights, dtype=float)
+        self.bin_edges = asarray(bin_edges, dtype=float)
+        self.size_mm = size_mm
+        self.x_lim = x_lim
+        self.y_lim = y_lim
+        self.x_ticks = x_ticks
+        self.y_ticks = y_ticks
+        self.color = color
+        self.border_width = border_width
+
+    def save(self, png_file):
+        """Draw the figure and write it to disk.
+
+        Parameters
+        ----------
+        png_file : str
+            path to the png file
+        """
+        fig, ax = _new_figure(self.size_mm)
+
+        is_bar = self.heights > 0  # no border for the empty bins
+        heights = self.heights[is_bar]
+        left = self.bin_edges[:-1][is_bar]
+        right = self.bin_edges[1:][is_bar]
+        bottom = zeros(heights.shape)
+        bars = stack([stack([left, bottom], axis=1),
+                      stack([left, heights], axis=1),
+                      stack([right, heights], axis=1),
+                      stack([right, bottom], axis=1)], axis=1)
+        ax.add_collection(PolyCollection(bars, facecolors=self.color,
+                                         edgecolors='k',
+                                         linewidths=_px_to_pt(
+                                             self.border_width)))
+
+        ax.set_xlim(self.x_lim)
+        ax.set_ylim(self.y_lim)
+        ax.xaxis.set_major_locator(MultipleLocator(self.x_ticks[0]))
+        ax.xaxis.set_minor_locator(MultipleLocator(self.x_ticks[1]))
+        ax.yaxis.set_major_locator(MultipleLocator(self.y_ticks[0]))
+        ax.yaxis.set_minor_locator(MultipleLocator(self.y_ticks[1]))
+        ax.tick_params(labelsize=TICKS_FONT_SIZE)
+        fig.tight_layout()
+
+        fig.savefig(png_file, dpi=DPI)
+
+
+class TraceFigure:
+    """Signal, with one period highlighted in the background and no axes.
+
+    Parameters
+    ----------
+    t : ndarray
+        time points
+    x : ndarray
+        signal
+    size_mm : tuple of 2 int
+        size in mm of the final image
+    y_lim : tuple of 2 float
+        limits of the y-axis
+    highlight : tuple of 2 float, optional
+        start and end time of the period to highlight
+    highlight_color : str or tuple
+        color of the highlighted period
+    """
+    def __init__(self, t, x, size_mm, y_lim, highlight=None,
+                 highlight_color='y'):
+        self.t = asarray(t, dtype=float)
+        self.x = asarray(x, dtype=float)
+        self.size_mm = size_mm
+        self.y_lim = y_lim
+        self.highlight = highlight
+        self.highlight_color = highlight_color
+
+    def save(self, png_file):
+        """Draw the figure and write it to disk.
+
+        Parameters
+        ----------
+        png_file : str
+            path to the png file
+        """
+        fig, ax = _new_figure(self.size_mm)
+        ax.set_position([0, 0, 1, 1])
+        ax.set_axis_off()
+
+        if self.highlight is not None:
+            ax.axvspan(*self.highlight, color=self.highlight_color,
+                       linewidth=0, zorder=-1)
+        ax.plot(self.t, self.x, color='k', linewidth=_px_to_pt(1))
+
+        ax.set_xlim(self.t[0], self.t[-1])
+        ax.set_ylim(self.y_lim)
+
+        fig.savefig(png_file, dpi=DPI)
+
+
+def heatmap_image(values, limits, colormap, nan_color, cell_px=1):
+    """Convert a matrix into an image, where each value is a square.
+
+    Parameters
+    ----------
+    values : ndarray
+        n_rows X n_columns matrix (row 0 is at the top of the image)
+    limits : tuple of 2 floats
+        values used for color scaling
+    colormap : str
+        name of the vispy colormap
+    nan_color : tuple of 4 float
+        RGBA color of the NaN values
+    cell_px : int
+        size in pixels of each value
+
+    Returns
+    -------
+    ndarray
+        (n_rows * cell_px) X (n_columns * cell_px) X 4 image (RGBA, uint8)
+    """
+    values = asarray(values, dtype=float)
+    is_nan = isnan(values)
+
+    norm_v = clip((values - limits[0]) / (limits[1] - limits[0]), 0, 1)
+    norm_v[is_nan] = 0
+    clr = get_colormap(colormap)[norm_v.reshape(-1)].rgba
+    clr[is_nan.reshape(-1), :] = nan_color
+    clr = clr.reshape(values.shape + (4, ))
+
+    clr = repeat(repeat(clr, cell_px, axis=0), cell_px, axis=1)
+    return (clr * 255).round().astype(uint8)
+
+
+def _new_figure(size_mm):
+    fig = Figure(figsize=tuple(x / 25.4 for x in size_mm), dpi=DPI,
+                 facecolor='w')
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(1, 1, 1)
+    return fig, ax
+
+
+def _px_to_pt(width):
+    return width * 72 / DPI
@@ -1,65 +1,50 @@
-from numpy import array, asarray, NaN, nanmean, nansum, mean, isnan, zeros
+from numpy import array, asarray, nan, isnan, where, zeros
 from vispy.color import get_colormap, ColorArray
-import warnings
 
-from phypno.viz import Viz3
 from phypno.viz.base import normalize
 
-from .constants import (AZIMUTH,
-                        COLORMAP,
-                        DPI,
-                        ELEVATION,
+from .constants import (COLORMAP,
                         NAN_COLOR,
+                        SATURATE_PVALUES,
                         SATURATION_LEVEL,
                         avg_surf,
                         avg_vert,
                         avg_regions,
                         )
+from .render import SurfaceFigure, values_to_colors
+from .smoothing import MeshSmoother
 
 cm = get_colormap(COLORMAP)
+smooth_avg = MeshSmoother(avg_surf.tri, avg_surf.vert.shape[0])
+avg_codes = asarray(avg_vert, dtype=int)  # index of the region of each vertex
 
 
-def plot_surf(all_values, size_mm, limits=None, extra_smoothing=True,
-              fun='mean'):
+def plot_surf(values, size_mm, limits=None, extra_smoothing=True):
     """Plot values onto the surface.
 
     Parameters
     ----------
-    all_values : list of Data
-        values for each subject
+    values : ndarray
+        values on the average surface, combined across subjects (see
+        project_to_avg)
     size_mm : tuple of 2 int
         size in pixels of the final image
     limits : tuple of 2 floats
         values used for color scaling
     extra_smoothing : bool
         if it should apply some extra smoothing
-    fun : str
-        'mean' or 'sum'
 
     Returns
     -------
-    instance of Viz3
+    instance of SurfaceFigure
         plot with the surfaces
     """
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")  # some columns are completely NaN
-        if fun == 'mean':
-            values = nanmean(asarray([x.data[0] for x in all_values]), axis=0)
-        elif fun == 'sum':
-            values = nansum(asarray([x.data[0] for x in all_values]), axis=0)
-
     if extra_smoothing:
         # apply some quick smoothing (but rather strong, useful to avoid the clown fish effect)
-        for one_tri in avg_surf.tri:
-            if not any(isnan(values[one_tri])):
-                values[one_tri] = mean(values[one_tri])
+        values = smooth_avg(values)
 
-    v = Viz3(dpi=DPI, show=False, size_mm=size_mm)
-    v.add_surf(avg_surf, values=values, limits_c=limits, color=NAN_COLOR,
-               colormap=COLORMAP)
-    v._plt.view.camera.elevation = ELEVATION
-    v._plt.view.camera.azimuth = AZIMUTH
-    return v
+    colors = values_to_colors(values, limits, COLORMAP, NAN_COLOR)
+    return SurfaceFigure(size_mm, vertex_colors=colors)
 
 
 def plot_lmer(coef, size_mm, pvalues=None, limits=(0, 2), p_threshold=0.05):
@@ -78,42 +63,41 @@ def plot_lmer(coef, size_mm, pvalues=None, limits=(0, 2), p_threshold=0.05):
     p_threshold : float, optional
         threshold for the pvalues
 
+    Notes
+    -----
+    The pvalues are used only if SATURATE_PVALUES is True: then the regions
+    which are not significant are shown with lower saturation.
+
     Returns
     -------
-    instance of Viz3
+    instance of SurfaceFigure
         plot with the surfaces
     """
-    val = zeros((avg_vert.shape[0], 4))
-    val.fill(NaN)
-
-    for one_region, one_v in coef.items():
-        if one_region not in avg_regions:
-            continue
-
-        idx = array(avg_vert) == avg_regions.index(one_region)
-        norm_v = normalize(one_v, *limits)
-        if True: # pvalues is None:
-            val[idx, :] = cm[norm_v].rgba
-
-        else:  # I think there is something wrong here
-            if pvalues[one_region] <= p_threshold:
-                level = 1.
-            else:
-                level = SATURATION_LEVEL
-            val[idx, :] = saturate(cm[norm_v], level).rgba
+    regions = [x for x in coef if x in avg_regions]
+    region_idx = [avg_regions.index(x) for x in regions]
+
+    # one color for each region, the last row is for vertices without values
+    lut = zeros((len(avg_regions) + 1, 4))
+    lut.fill(nan)
+    if regions:
+        norm_v = normalize(array([coef[x] for x in regions]), *limits)
+        colors = cm[norm_v]
+        if pvalues is not None and SATURATE_PVALUES:
+            is_sign = array([pvalues[x] <= p_threshold for x in regions])
+            colors = saturate(colors, where(is_sign, 1., SATURATION_LEVEL))
+        lut[region_idx, :] = colors.rgba
+
+    val = lut[avg_codes]
 
     hasnan = isnan(val).all(axis=1)
     val[hasnan, :] = NAN_COLOR
 
-    v = Viz3(dpi=DPI, show=False, size_mm=size_mm)
-    v.add_surf(avg_surf, vertex_colors=val, color=NAN_COLOR)
-    v._plt.view.camera.elevation = ELEVATION
-    v._plt.view.camera.azimuth = AZIMUTH
-    return v
+    return SurfaceFigure(size_mm, vertex_colors=val)
 
 
 def saturate(c, level=0.5):
-    """Only works if colormap has constant saturation"""
+    """Set the saturation of the colors to level (one value, or one value for
+    each color). Only works if colormap has constant saturation"""
     c = c.hsv
-    c[0, 1] = level
+    c[:, 1] = level
     return ColorArray(color=c, color_space='hsv')
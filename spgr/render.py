@@ -0,0 +1,394 @@
+"""Offscreen rendering of surfaces, without Qt.
+
+All the surface figures are drawn on the same offscreen canvas. Each surface
+is uploaded once, and then only its vertex colors change from one figure to
+the next.
+"""
+from functools import lru_cache
+from hashlib import md5
+from importlib import import_module
+from inspect import getsourcefile
+from logging import getLogger
+from multiprocessing import get_context
+from os import close, link, remove, replace
+from os.path import dirname, getmtime
+from shutil import copyfile
+from tempfile import mkstemp
+
+from numpy import (asarray,
+                   clip,
+                   isnan,
+                   nanmax,
+                   nanmin,
+                   ndarray,
+                   r_,
+                   tile,
+                   zeros)
+from vispy import use
+from vispy.color import get_colormap
+from vispy.gloo import VertexBuffer
+from vispy.io import write_png
+from vispy.scene import SceneCanvas
+from vispy.scene.cameras import TurntableCamera
+from vispy.scene.visuals import Markers, Mesh
+
+from . import constants
+from .constants import (AZIMUTH,
+                        COLORMAP,
+                        DPI,
+                        ELEVATION,
+                        FIGURE_CACHE_PATH,
+                        NAN_COLOR,
+                        RENDER_APP,
+                        RENDER_WORKERS,
+                        )
+from .surfaces import get_surface
+
+lg = getLogger(__name__)
+
+DEFAULT_CAMERA = {'elevation': 30., 'azimuth': 30.}  # as in TurntableCamera
+
+try:
+    use(app=RENDER_APP)
+except RuntimeError:  # another backend was already selected
+    lg.warning('Could not use ' + RENDER_APP + ' for rendering')
+
+
+class SurfaceFigure:
+    """Description of a figure with one surface, which is rendered only when
+    saved.
+
+    Parameters
+    ----------
+    size_mm : tuple of 2 int
+        size in mm of the final image (the number of pixels depends on DPI)
+    subj : str, optional
+        subject code (if None, the average surface)
+    hemi : str, optional
+        'lh' or 'rh' (only for the surface of a subject)
+    vertex_colors : ndarray, optional
+        n_vert X 4 RGBA color of each vertex
+    color : tuple of 4 float
+        RGBA color of the whole surface, if vertex_colors is None
+    chan_xyz : ndarray, optional
+        n_chan X 3 position of the channels to plot as markers
+    chan_color : tuple of 4 float
+        RGBA color of the channels
+    elevation, azimuth : float, optional
+        angles of the camera (if None, DEFAULT_CAMERA)
+    scale_factor : float, optional
+        zoom of the camera (if None, the whole surface is shown)
+    """
+    def __init__(self, size_mm, subj=None, hemi=None, vertex_colors=None,
+                 color=NAN_COLOR, chan_xyz=None, chan_color=NAN_COLOR,
+                 elevation=ELEVATION, azimuth=AZIMUTH, scale_factor=None):
+        self.size_mm = size_mm
+        self.subj = subj
+        self.hemi = hemi
+        self.vertex_colors = vertex_colors
+        self.color = color
+        self.chan_xyz = chan_xyz
+        self.chan_color = chan_color
+        self.elevation = elevation
+        self.azimuth = azimuth
+        self.scale_factor = scale_factor
+
+    def save(self, png_file):
+        """Render the figure and write it to disk.
+
+        Parameters
+        ----------
+        png_file : str
+            path to the png file
+        """
+        write_png(png_file, get_renderer().render(self))
+
+
+class FigureQueue:
+    """Collect figures and render them all at once in a pool of processes.
+
+    Parameters
+    ----------
+    n_workers : int, optional
+        number of processes (if None, RENDER_WORKERS)
+
+    Notes
+    -----
+    Use it as context manager: the figures are rendered when leaving the
+    context. The processes are started with "spawn", so that each one creates
+    its own offscreen canvas instead of sharing the GL context of the parent.
+
+    Each figure is rendered into FIGURE_CACHE_PATH, with the hash of the
+    figure (all its attributes, including the arrays, and the render settings)
+    as file name, and then linked to its png file. Figures which were already
+    rendered in a previous run, or which are already in the queue, are not
+    rendered again. Each figure is written to a temporary file, which is
+    renamed only when complete, so a failed render never ends up in the cache.
+    See figure_hash for what invalidates the cache; to clear it, delete the
+    folder FIGURE_CACHE_PATH (it is created again at the next run).
+    """
+    def __init__(self, n_workers=RENDER_WORKERS):
+        self.n_workers = n_workers
+        self.jobs = []
+        self.links = []
+        self.queued = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.run()
+
+    def submit(self, fig, png_file):
+        """Add one figure to the queue.
+
+        Parameters
+        ----------
+        fig : instance of SurfaceFigure
+            figure (or any object with a method .save(png_file) which can be
+            pickled)
+        png_file : str
+            path to the png file
+
+        Returns
+        -------
+        str
+            path to the png file, which exists once the queue has run
+        """
+        cache_file = FIGURE_CACHE_PATH / (figure_hash(fig) + '.png')
+        if not cache_file.exists() and str(cache_file) not in self.queued:
+            self.jobs.append((fig, str(cache_file)))
+            self.queued.add(str(cache_file))
+        self.links.append((cache_file, png_file))
+        return png_file
+
+    def run(self):
+        """Render all the figures in the queue.
+
+        Returns
+        -------
+        list of str
+            paths to the png files
+        """
+        jobs, self.jobs = self.jobs, []
+        links, self.links = self.links, []
+        self.queued = set()
+        lg.debug('Rendering {} figures ({} already rendered)'
+                 ''.format(len(links), len(links) - len(jobs)))
+
+        if self.n_workers == 1 or len(jobs) <= 1:
+            list(map(_save_figure, jobs))
+        else:
+            with get_context('spawn').Pool(self.n_workers) as p:
+                p.map(_save_figure, jobs)
+
+        for cache_file, png_file in links:
+            try:
+                link(str(cache_file), png_file)
+            except OSError:  # file system without hard links
+                copyfile(str(cache_file), png_file)
+
+        return [png_file for _, png_file in links]
+
+
+class SurfaceRenderer:
+    """Offscreen canvas, which keeps the meshes of the surfaces already
+    rendered.
+
+    Notes
+    -----
+    The vertices, faces and normals of each surface are uploaded only once.
+    The colors are in a separate vertex buffer, which is the only data that
+    changes from one figure to the next.
+    """
+    def __init__(self):
+        self.canvas = SceneCanvas(show=False, bgcolor='white')
+        self.view = self.canvas.central_widget.add_view()
+        self.view.camera = TurntableCamera()
+        self.markers = Markers(parent=self.view.scene)
+        self.markers.visible = False
+        self.meshes = {}
+        self.faces = {}
+        self.colors = {}
+
+    def render(self, fig):
+        """Render one figure.
+
+        Parameters
+        ----------
+        fig : instance of SurfaceFigure
+            the figure to render
+
+        Returns
+        -------
+        ndarray
+            height X width X 4 image (RGBA, uint8)
+        """
+        key = fig.subj, fig.hemi
+        surf = _get_surf(*key)
+        for mesh in self.meshes.values():
+            mesh.visible = False
+        mesh = self._get_mesh(key, surf)
+
+        if fig.vertex_colors is None:
+            colors = tile(fig.color, (surf.vert.shape[0], 1))
+        else:
+            colors = fig.vertex_colors
+        # the mesh is drawn with one vertex for each corner of each triangle
+        colors = asarray(colors, dtype='float32')[self.faces[key]]
+        self.colors[key].set_data(colors.reshape(-1, 4))
+        mesh.visible = True
+
+        # hidden visuals count in the bounds of the scene, so the range is
+        # computed on the visible ones only
+        xyz = asarray(surf.vert)
+        if fig.chan_xyz is None:
+            self.markers.visible = False
+        else:
+            self.markers.set_data(asarray(fig.chan_xyz),
+                                  face_color=fig.chan_color, edge_width=0)
+            self.markers.visible = True
+            xyz = r_[xyz, asarray(fig.chan_xyz)]
+
+        self.canvas.size = _size_px(fig.size_mm)
+        camera = self.view.camera
+        camera.set_range(*zip(xyz.min(axis=0), xyz.max(axis=0)))
+        for angle in ('elevation', 'azimuth'):
+            value = getattr(fig, angle)
+            if value is None:
+                value = DEFAULT_CAMERA[angle]
+            setattr(camera, angle, value)
+        if fig.scale_factor is not None:
+            camera.scale_factor = fig.scale_factor
+
+        return self.canvas.render()
+
+    def _get_mesh(self, key, surf):
+        """Upload the surface only the first time it is used, and then replace
+        the colors of the mesh with a buffer which can be updated alone."""
+        if key not in self.meshes:
+            faces = asarray(surf.tri)
+            mesh = Mesh(vertices=asarray(surf.vert), faces=faces,
+                        vertex_colors=tile(NAN_COLOR, (surf.vert.shape[0], 1)),
+                        shading='smooth', parent=self.view.scene)
+            mesh._update_data()  # upload vertices, faces and normals now
+
+            self.colors[key] = VertexBuffer(zeros((faces.size, 4),
+                                                  dtype='float32'))
+            mesh.shared_program.vert['base_color'] = self.colors[key]
+            self.faces[key] = faces
+            self.meshes[key] = mesh
+        return self.meshes[key]
+
+
+@lru_cache(maxsize=None)
+def get_renderer():
+    """The renderer of this process (it is created only once)."""
+    return SurfaceRenderer()
+
+
+def values_to_colors(values, limits=None, colormap=COLORMAP,
+                     nan_color=NAN_COLOR):
+    """Convert values into colors.
+
+    Parameters
+    ----------
+    values : ndarray
+        one value for each vertex
+    limits : tuple of 2 floats, optional
+        values used for color scaling (if None, min and max of the values)
+    colormap : str
+        name of the vispy colormap
+    nan_color : tuple of 4 float
+        RGBA color of the NaN values
+
+    Returns
+    -------
+    ndarray
+        n_vert X 4 RGBA colors
+    """
+    values = asarray(values, dtype=float)
+    if limits is None:
+        limits = nanmin(values), nanmax(values)
+
+    norm_v = clip((values - limits[0]) / (limits[1] - limits[0]), 0, 1)
+    is_nan = isnan(values)
+    norm_v[is_nan] = 0
+
+    colors = get_colormap(colormap)[norm_v].rgba
+    colors[is_nan, :] = nan_color
+
+    return colors
+
+
+def figure_hash(fig):
+    """Hash of a figure and of the settings used to render it.
+
+    Parameters
+    ----------
+    fig : instance of SurfaceFigure
+        figure (or any object whose attributes describe the figure)
+
+    Returns
+    -------
+    str
+        md5 hexdigest
+
+    Notes
+    -----
+    Besides the attributes of the figure, the hash includes the source code of
+    this module and of the module which defines the figure, and the time when
+    the surface was last modified, so a change in the code or in the surface
+    renders the figures again. Anything else that changes the image needs a
+    new attribute (or delete FIGURE_CACHE_PATH to render all the figures
+    again).
+    """
+    h = md5()
+    h.update(repr((type(fig).__name__, DPI, RENDER_APP,
+                   sorted(DEFAULT_CAMERA.items()))).encode())
+    h.update(_source_hash(__name__).encode())
+    h.update(_source_hash(type(fig).__module__).encode())
+    if isinstance(fig, SurfaceFigure):
+        surf_file = str(_get_surf(fig.subj, fig.hemi).surf_file)
+        h.update(repr((surf_file, getmtime(surf_file))).encode())
+    for name, value in sorted(vars(fig).items()):
+        h.update(name.encode())
+        if isinstance(value, ndarray):
+            h.update(repr((value.shape, value.dtype.str)).encode())
+            h.update(value.tobytes())
+        else:
+            h.update(repr(value).encode())
+    return h.hexdigest()
+
+
+@lru_cache(maxsize=None)
+def _source_hash(module_name):
+    """md5 of the source file of a module (computed once per process)."""
+    with open(getsourcefile(import_module(module_name)), 'rb') as f:
+        return md5(f.read()).hexdigest()
+
+
+def _save_figure(job):
+    """Save the figure to a temporary file in the same folder, and then rename
+    it, so that png_file is either complete or missing."""
+    fig, png_file = job
+    fid, tmp_file = mkstemp(suffix='.png', dir=dirname(png_file))
+    close(fid)
+    try:
+        fig.save(tmp_file)
+        replace(tmp_file, png_file)
+    except BaseException:
+        remove(tmp_file)
+        raise
+
+
+def _get_surf(subj, hemi):
+    if subj is None:
+        return constants.avg_surf
+    else:
+        return get_surface(subj, hemi)
+
+
+def _size_px(size_mm):
+    return tuple(int(x / 25.4 * DPI) for x in size_mm)
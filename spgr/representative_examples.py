@@ -1,16 +1,12 @@
 from numpy import log, mean, where
 from phypno.trans import Filter, Select
-from phypno.viz import Viz1
 from scipy.signal import periodogram
-from vispy.scene import LinePlot, Rectangle
 
 from .constants import (CHAN_TYPE,
                         DATA_OPTIONS,
                         DEFAULT_HEMI,
-                        DPI,
                         HEMI_SUBJ,
                         HIGHLIGHT_COLOR,
-                        HIGHLIGHT_HEIGHT,
                         RAW_LIMITS_Y,
                         REPR_PLOT_SIZE,
                         SPINDLE_OPTIONS,
@@ -18,8 +14,10 @@ from .constants import (CHAN_TYPE,
                         fs,
                         )
 from .detect_spindles import get_spindles
+from .plot_2d import TraceFigure
 from .read_data import get_data
-from .spindle_source import get_chan_with_regions
+from .render import FigureQueue
+from .spindle_source import get_region_codes
 
 from .log import with_log
 
@@ -43,6 +41,7 @@ def Representative_Examples(lg, images_dir):
     # create dict with empty lists
     regions_with_png = {k: [] for k in avg_regions}
 
+    figures = FigureQueue()
     for subj in HEMI_SUBJ:
 
         data = get_data(subj, 'sleep', CHAN_TYPE, reref=REREF, **DATA_OPTIONS)
@@ -60,9 +59,10 @@ def Representative_Examples(lg, images_dir):
 
             png_file = str(images_dir.joinpath('{}_{}.png'.format(region,
                                                                   subj)))
-            v.save(png_file)
+            figures.submit(v, png_file)
 
             regions_with_png[region].append(png_file)
+    figures.run()
 
     for region, png_files in regions_with_png.items():
         _, y, z = _find_region_xyz(region)
@@ -73,9 +73,7 @@ def Representative_Examples(lg, images_dir):
 
 
 def _plot_highlighted_spindle(spindle_data, spindle):
-    """Plot signal and spindles. Don't use viz1.add_data because it creates
-    axes by default and I don't know how to remove them. Instead we create a
-    simple figure.
+    """Plot signal and highlight the detected spindle, without axes.
 
     Parameters
     ----------
@@ -86,36 +84,19 @@ def _plot_highlighted_spindle(spindle_data, spindle):
 
     Returns
     -------
-    instance of Viz
-        the actual figure, so that you can save it to disk.
+    instance of TraceFigure
+        the figure, so that you can save it to disk.
     """
     t = spindle_data.axis['time'][0]
     x = spindle_data.data[0][0]
 
-    v = Viz1(dpi=DPI, size_mm=REPR_PLOT_SIZE)
-
-    # set defaults
-    plt = v._fig[0, 0]
-    plt.view.camera = 'panzoom'
-    plt.grid.margin = 0
-    plt.title.stretch = (1, 0)
-
-    # signal
-    line = LinePlot((t, x), connect='strip', color='k', line_kind='-',
-                    width=1.)
-    plt.view.add(line)
-    plt.view.camera.set_range(x=(t[0], t[-1]), y=(RAW_LIMITS_Y))
-
-    # highlight detected spindle
+    # highlight detected spindle (half of its duration, around its center)
     time_center = (spindle['end_time'] + spindle['start_time']) / 2
     width = spindle['end_time'] - time_center
+    highlight = time_center - width / 2, time_center + width / 2
 
-    rect = Rectangle(center=(time_center, 0), width=width,
-                     color=HIGHLIGHT_COLOR, height=HIGHLIGHT_HEIGHT)
-    rect.order = -1
-    plt.view.add(rect)
-
-    return v
+    return TraceFigure(t, x, REPR_PLOT_SIZE, RAW_LIMITS_Y,
+                       highlight=highlight, highlight_color=HIGHLIGHT_COLOR)
 
 
 def find_best_spindles(subj, data):
@@ -134,18 +115,17 @@ def find_best_spindles(subj, data):
         dictionary, each brain region has the best spindle.
     """
     spindles = get_spindles(subj, reref=REREF, **SPINDLE_OPTIONS)
-    chan = get_chan_with_regions(subj, REREF, 'aparc')
+    labels, codes, regions = get_region_codes(subj, REREF, parc_type='aparc')
+    chan_codes = dict(zip(labels, codes))
 
     best_spindles = {}
 
     for one_sp in spindles:
-        sp_region = chan(lambda x: x.label == one_sp['chan']).return_attr('region')[0]
-
-        # aparc uses "ctx-Xh" and aparc.a2009s uses "ctx_Xh"
-        if not sp_region.startswith('ctx'):
+        # only spindles in cortical regions
+        if chan_codes[one_sp['chan']] < 0:
             continue
 
-        sp_region = sp_region[len('ctx-Xh-'):]
+        sp_region = regions[chan_codes[one_sp['chan']]]
 
         # there are different ways to define the best spindle.
         # the quality of a spindle will be stored in goodness (the higher the better)
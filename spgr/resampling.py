@@ -0,0 +1,343 @@
+"""Non-parametric inference at the level of the subjects.
+
+The subjects are the independent units, so the tests flip the sign of the
+values of whole subjects (which is the permutation test for one-sample and
+paired designs). The same sign is used for all the columns of one subject, so
+that the max-statistic keeps the dependence between regions.
+"""
+from multiprocessing import Pool
+
+from numpy import (abs,
+                   arange,
+                   bincount,
+                   errstate,
+                   isfinite,
+                   nan,
+                   nanpercentile,
+                   ones,
+                   sqrt,
+                   where,
+                   zeros)
+from numpy.random import default_rng, SeedSequence
+
+from .constants import (BOOTSTRAP_CI,
+                        N_BOOTSTRAP,
+                        N_PERMUTATIONS,
+                        PERM_CORRECTION)
+from .mixed_model import p_adjust
+from .stats_cache import cached_stats
+
+
+PERM_CHUNK = 1000  # sign flips computed by each task in the pool
+PERM_MAX_BYTES = 2 ** 26  # max memory for one block of sign flips
+
+
+def subject_region_sums(frame, column):
+    """Sum the values of each subject in each region.
+
+    Parameters
+    ----------
+    frame : instance of ElectrodeFrame
+        table with one row for each electrode
+    column : str
+        column with the values
+
+    Returns
+    -------
+    ndarray
+        n_subjects X n_regions with the sum of the values (NaN are ignored)
+    ndarray
+        n_subjects X n_regions with the number of electrodes with values
+    list of str
+        names of the regions (sorted)
+    """
+    subj, _ = frame.categories('subj')
+    region, regions = frame.categories('region')
+    values = frame[column]
+    is_valid = isfinite(values)
+
+    n_subj = subj.max() + 1 if len(subj) else 0
+    idx = subj[is_valid] * len(regions) + region[is_valid]
+    n_cells = n_subj * len(regions)
+
+    sums = bincount(idx, weights=values[is_valid], minlength=n_cells)
+    counts = bincount(idx, minlength=n_cells)
+
+    return (sums.reshape(n_subj, len(regions)),
+            counts.reshape(n_subj, len(regions)), regions)
+
+
+def region_deviations(frame, column):
+    """Compute, for each subject, how much the mean of each region differs
+    from the mean of all the electrodes of that subject. This removes the
+    intercept of each subject, like the random intercept in lmer.
+
+    Parameters
+    ----------
+    frame : instance of ElectrodeFrame
+        table with one row for each electrode
+    column : str
+        column with the values
+
+    Returns
+    -------
+    ndarray
+        n_subjects X n_regions (NaN if the subject has no electrode in the
+        region)
+    list of str
+        names of the regions (sorted)
+    """
+    sums, counts, regions = subject_region_sums(frame, column)
+
+    with errstate(invalid='ignore', divide='ignore'):
+        subj_mean = sums.sum(axis=1) / counts.sum(axis=1)
+        dev = sums / counts - subj_mean[:, None]
+    dev[counts == 0] = nan
+
+    return dev, regions
+
+
+def sign_flip_test(x, n_perm=N_PERMUTATIONS, correction='max', seed_value=0,
+                   parallel=True):
+    """One-sample t-test against zero, with p-values from random sign flips
+    of the subjects.
+
+    Parameters
+    ----------
+    x : ndarray
+        n_subjects X n_tests, NaN for missing values (for a paired test, use
+        the difference between the conditions)
+    n_perm : int
+        number of random sign flips
+    correction : str
+        'max' (max-statistic over the tests, controls FWER), or any method of
+        p_adjust ('fdr', 'holm', 'bonferroni', 'none') applied to the
+        uncorrected permutation p-values
+    seed_value : int
+        seed for the random number generator
+    parallel : bool
+        compute the sign flips in a pool of processes
+
+    Returns
+    -------
+    ndarray
+        t-statistic for each test
+    ndarray
+        two-tailed (corrected) p-value for each test (NaN for tests with less
+        than two subjects)
+
+    Notes
+    -----
+    The sign flips are split into chunks of PERM_CHUNK, each with its own
+    random stream (spawned from the same SeedSequence), so the results do not
+    depend on the number of processes.
+    """
+    n_valid = isfinite(x).sum(axis=0)
+    x0 = where(isfinite(x), x, 0)
+
+    t_obs = _t_stat(ones((1, x.shape[0])), x0, n_valid)[0]
+    is_valid = isfinite(t_obs)
+    abs_obs = abs(t_obs)
+
+    n_chunks = -(-n_perm // PERM_CHUNK)
+    seeds = SeedSequence(seed_value).spawn(n_chunks)
+    chunks = [(x0, n_valid, abs_obs, min(PERM_CHUNK, n_perm - i * PERM_CHUNK),
+               seed) for i, seed in enumerate(seeds)]
+
+    if parallel and n_chunks > 1:
+        with Pool() as p:
+            counts = p.map(_count_extreme, chunks)
+    else:
+        counts = list(map(_count_extreme, chunks))
+
+    n_extreme = sum(c[0] for c in counts)
+    n_max = sum(c[1] for c in counts)
+
+    if correction == 'max':
+        pvalues = (n_max + 1) / (n_perm + 1)
+    else:
+        pvalues = p_adjust((n_extreme + 1) / (n_perm + 1), correction)
+    pvalues[~is_valid] = nan
+
+    return t_obs, pvalues
+
+
+def region_permutation(frame, column, n_perm=N_PERMUTATIONS,
+                       correction=PERM_CORRECTION):
+    """Test if each region differs from the mean of the subject, with sign
+    flips of the subjects (the non-parametric alternative to lmer).
+
+    Parameters
+    ----------
+    frame : instance of ElectrodeFrame
+        table with one row for each electrode
+    column : str
+        column with the values
+    n_perm : int
+        number of random sign flips
+    correction : str
+        'max' or method of p_adjust (see sign_flip_test)
+
+    Returns
+    -------
+    dict
+        t-statistic for each region
+    dict
+        corrected p-value for each region
+    """
+    key = ('permutation', frame.hash(), column, n_perm, correction,
+           PERM_CHUNK)
+
+    def _compute():
+        dev, regions = region_deviations(frame, column)
+        tstat, pvalues = sign_flip_test(dev, n_perm, correction)
+        return dict(zip(regions, tstat)), dict(zip(regions, pvalues))
+
+    return cached_stats(key, _compute)
+
+
+def report_permutation(lg, tstat, pvalues, p_threshold):
+    """Report the regions which are significant with the sign-flip test.
+
+    Parameters
+    ----------
+    lg : instance of logging.Logger
+        logging template
+    tstat : dict
+        t-statistic for each region
+    pvalues : dict
+        corrected p-value for each region
+    p_threshold : float
+        threshold for p-value to show values
+    """
+    lg.info('Sign-flip test ({} sign flips, {} correction)'
+            ''.format(N_PERMUTATIONS, PERM_CORRECTION))
+    for region, _ in sorted(tstat.items(), key=lambda x: x[1]):
+        if pvalues[region] <= p_threshold:
+            lg.info('{:30} t={:.3f},  p-value = {:.3f}'
+                    ''.format(region, tstat[region], pvalues[region]))
+
+
+def region_bootstrap(frame, column, n_boot=N_BOOTSTRAP, ci=BOOTSTRAP_CI,
+                     seed_value=0):
+    """Confidence intervals of the mean of each region, by resampling the
+    subjects with replacement.
+
+    Parameters
+    ----------
+    frame : instance of ElectrodeFrame
+        table with one row for each electrode
+    column : str
+        column with the values
+    n_boot : int
+        number of bootstrap samples
+    ci : float
+        coverage of the confidence interval (0.95 for 95%)
+    seed_value : int
+        seed for the random number generator
+
+    Returns
+    -------
+    dict
+        for each region, the mean over subjects of the mean of each subject
+    dict
+        for each region, the lower and upper limit of the interval of that
+        mean (NaN if there are no electrodes in that region)
+
+    Notes
+    -----
+    Each bootstrap sample is a vector with how many times each subject was
+    drawn (multinomial), so all the samples are computed with one matrix
+    product on the mean of each subject in each region. The mean of a region
+    is the mean over subjects, which is close to, but not the same as, the
+    estimate of lmer, so the interval is reported with its own mean.
+    """
+    key = ('bootstrap_mean', frame.hash(), column, n_boot, ci, seed_value)
+
+    def _compute():
+        sums, counts, regions = subject_region_sums(frame, column)
+        with errstate(invalid='ignore', divide='ignore'):
+            subj_mean = where(counts > 0, sums / counts, 0)
+            region_mean = subj_mean.sum(axis=0) / (counts > 0).sum(axis=0)
+
+        rng = default_rng(seed_value)
+        n_subj = counts.shape[0]
+        weights = rng.multinomial(n_subj, ones(n_subj) / n_subj, size=n_boot)
+
+        with errstate(invalid='ignore', divide='ignore'):
+            boot = weights.dot(subj_mean) / weights.dot(counts > 0)
+        limits = nanpercentile(boot, [50 * (1 - ci), 50 * (1 + ci)], axis=0)
+
+        return (dict(zip(regions, region_mean)),
+                {region: tuple(lim) for region, lim in zip(regions, limits.T)})
+
+    return cached_stats(key, _compute)
+
+
+def report_bootstrap(lg, boot_mean, ci, coef=None):
+    """Report the mean of each region with its confidence interval, as a
+    table.
+
+    Parameters
+    ----------
+    lg : instance of logging.Logger
+        logging template
+    boot_mean : dict
+        mean over subjects for each region
+    ci : dict
+        lower and upper limit of that mean for each region
+    coef : dict, optional
+        estimate of lmer for each region, shown next to the mean for
+        comparison (the interval does not refer to it)
+    """
+    lg.info('Bootstrap over subjects ({} samples, {:.0f}% CI)\n'
+            ''.format(N_BOOTSTRAP, BOOTSTRAP_CI * 100))
+    header = '| region | mean | CI |'
+    rule = '|---|---:|---:|'
+    if coef is not None:
+        header += ' lmer coef |'
+        rule += '---:|'
+    lg.info(header)
+    lg.info(rule)
+    for region, _ in sorted(boot_mean.items(), key=lambda x: x[1]):
+        row = ('| {} | {:.3f} | [{:.3f}, {:.3f}] |'
+               ''.format(region, boot_mean[region], *ci[region]))
+        if coef is not None:
+            row += ' {:.3f} |'.format(coef.get(region, nan))
+        lg.info(row)
+    lg.info('')
+
+
+def _count_extreme(args):
+    """Count how many times the t-statistic of random sign flips is more
+    extreme than the observed one, for each test and for the max over tests.
+    """
+    x0, n_valid, abs_obs, n_perm, seed = args
+    rng = default_rng(seed)
+    is_valid = isfinite(abs_obs)
+
+    block = max(1, PERM_MAX_BYTES // (8 * x0.size))
+    n_extreme = zeros(x0.shape[1], dtype=int)
+    n_max = zeros(x0.shape[1], dtype=int)
+    for i in arange(0, n_perm, block):
+        n_block = min(block, n_perm - i)
+        signs = rng.integers(0, 2, size=(n_block, x0.shape[0])) * 2. - 1
+        abs_null = abs(_t_stat(signs, x0, n_valid))
+        abs_null[:, ~is_valid] = 0
+
+        n_extreme += (abs_null >= abs_obs).sum(axis=0)
+        n_max += (abs_null.max(axis=1)[:, None] >= abs_obs).sum(axis=0)
+
+    return n_extreme, n_max
+
+
+def _t_stat(signs, x0, n_valid):
+    """One-sample t-statistic for each sign flip (rows of signs), where the
+    missing values in x0 are 0. The sum of squares does not depend on the
+    signs, so only the sums need to be computed for each sign flip.
+    """
+    with errstate(invalid='ignore', divide='ignore'):
+        m = signs.dot(x0) / n_valid
+        ss = (x0 ** 2).sum(axis=0) / n_valid
+        sd = sqrt((ss - m ** 2) * n_valid / (n_valid - 1))
+        return m / (sd / sqrt(n_valid))
@@ -1,4 +1,10 @@
-from numpy import concatenate, expand_dims, linspace, uint8
+from numpy import (array,
+                   bincount,
+                   concatenate,
+                   errstate,
+                   expand_dims,
+                   linspace,
+                   uint8)
 from vispy.color import get_colormap
 from vispy.io.image import write_png
 
@@ -10,78 +16,127 @@ from .constants import (ALL_REREF,
                         HEMI_SUBJ,
                         P_CORRECTION,
                         P_THRESHOLD,
+                        REGION_TEST,
                         SINGLE_CHAN_LIMITS,
                         SPINDLE_OPTIONS,
                         SURF_PLOT_SIZE,
                         )
 from .detect_spindles import get_spindles
-from .lmer_stats import add_to_dataframe, lmer
+from .lmer_stats import (ElectrodeFrame,
+                         compare_backends,
+                         lmer_batch,
+                         report_values)
 from .plot_spindles import plot_lmer
 from .read_data import keep_time_chan
-from .spindle_source import get_chan_with_regions
+from .render import FigureQueue
+from .resampling import (region_bootstrap,
+                         region_permutation,
+                         report_bootstrap,
+                         report_permutation)
+from .spindle_source import get_region_codes
 
 from .log import with_log
 
+S_FREQ = DATA_OPTIONS['resample_freq']
+
 
 @with_log
 def Single_Channel_Statistics(lg, images_dir):
 
     lg.info('## Spindle Properties: Descriptive')
 
+    figures = FigureQueue()
     for reref in ALL_REREF:
-        plot_average_values(reref, lg, images_dir)
+        plot_average_values(reref, lg, images_dir, figures)
+    figures.run()
 
     make_colorbar(lg, images_dir)
 
 
-def get_spindle_param(subj, param, ref):
-    """Param: 'density', 'duration', 'peak_freq', 'peak_val'"""
+def get_channel_properties(subj, ref, labels):
+    """Compute the properties of the spindles in each channel, in one pass
+    over the spindles.
+
+    Parameters
+    ----------
+    subj : str
+        subject code
+    ref : str or int
+        'avg' or 15, for average reference or bipolar montage
+    labels : ndarray of str
+        labels of the channels
+
+    Returns
+    -------
+    dict of ndarray
+        for each channel, 'count' (number of spindles), 'density' (spindles
+        per minute), and the mean 'duration' (in s), 'peak_freq' and
+        'peak_val' (NaN for channels without spindles)
+    """
     spindles = get_spindles(subj, chan_type=CHAN_TYPE, reref=ref,
                             **SPINDLE_OPTIONS)
 
-    if param == 'density':
-        dat_count = spindles.to_data('count')
+    chan_idx = {label: i for i, label in enumerate(labels)}
+    chan = array([chan_idx.get(sp['chan'], -1) for sp in spindles.spindle],
+                 dtype=int)
+    sp_values = array([(sp['end_time'] - sp['start_time'], sp['peak_freq'],
+                        sp['peak_val']) for sp in spindles.spindle],
+                      dtype=float).reshape(-1, 3)
+    in_chan = chan >= 0
+    chan = chan[in_chan]
+    sp_values = sp_values[in_chan]
+
+    count = bincount(chan, minlength=len(labels))
+
+    time = keep_time_chan(subj, ref)[0]
+    n_min = sum(len(one_trl) for one_trl in time) / S_FREQ / 60
+
+    values = {'count': count,
+              'density': count / n_min,
+              }
+    for i, param in enumerate(('duration', 'peak_freq', 'peak_val')):
+        sums = bincount(chan, weights=sp_values[:, i], minlength=len(labels))
+        with errstate(invalid='ignore'):
+            values[param] = sums / count
 
-        time = keep_time_chan(subj, ref)[0]
-        n_trl = len(time)
-        n_min = (n_trl * (time[0][-1] - time[0][0])) / 60
-        values = dat_count.data[0] / n_min
+    return values
 
-    elif param == 'duration':
-        for one_spindle in spindles.spindle:
-            one_spindle['duration'] = (one_spindle['end_time'] -
-                                       one_spindle['start_time'])
-        data = spindles.to_data('duration')
-        values = data.data[0]
 
-    else:
-        data = spindles.to_data(param)
-        values = data.data[0]
+def plot_average_values(REREF, lg, images_dir, figures):
+    params = ('density', 'peak_freq', 'peak_val', 'duration')
 
-    return values
+    dataframe = ElectrodeFrame(columns=params)
 
+    for subj in HEMI_SUBJ:
+        region_codes = get_region_codes(subj, REREF)
+        values = get_channel_properties(subj, REREF, region_codes[0])
+        dataframe.add(subj, values, region_codes)
 
-def plot_average_values(REREF, lg, images_dir):
-    for param in ('density', 'peak_freq', 'peak_val', 'duration'):
-
-        limits = SINGLE_CHAN_LIMITS[param]
+    fit = lmer_batch(dataframe, params, adjust=P_CORRECTION)
+    compare_backends(dataframe, lg, params, adjust=P_CORRECTION)
 
-        dataframe = {'subj': [], 'region': [], 'elec': [], 'value': []}
+    for param in params:
 
-        for subj in HEMI_SUBJ:
-            values = get_spindle_param(subj, param, REREF)
-            chan = get_chan_with_regions(subj, REREF)
-            add_to_dataframe(dataframe, subj, values, chan)
+        limits = SINGLE_CHAN_LIMITS[param]
 
         lg.info('### {} ({})'.format(param, REREF))
 
         lg.info('\nCorrected at {} {}'.format(P_CORRECTION, P_THRESHOLD))
-        coef, pvalues = lmer(dataframe, lg, adjust=P_CORRECTION,
-                             pvalue=P_THRESHOLD)
+        coef, pvalues, intercept = fit[param]
+        report_values(lg, coef, pvalues, intercept, P_THRESHOLD)
+
+        tstat, perm_pvalues = region_permutation(dataframe, param)
+        report_permutation(lg, tstat, perm_pvalues, P_THRESHOLD)
+        if REGION_TEST == 'permutation':
+            pvalues = perm_pvalues
+
+        boot_mean, ci = region_bootstrap(dataframe, param)
+        report_bootstrap(lg, boot_mean, ci, coef)
+
         v = plot_lmer(coef, pvalues=pvalues, limits=limits,
                       size_mm=SURF_PLOT_SIZE)
         png_file = str(images_dir.joinpath('{}_{}.png'.format(param, REREF)))
-        v.save(png_file)
+        figures.submit(v, png_file)
         lg.info('![{}]({})'.format('{} {}'.format(REREF, param), png_file))
 
 
@@ -0,0 +1,61 @@
+"""Smooth values on a triangulated surface with sparse matrices."""
+from numpy import arange, asarray, errstate, isnan, ones, repeat, where
+from scipy.sparse import csr_matrix
+
+
+class MeshSmoother:
+    """Average the values of the vertices within each triangle, and then the
+    values of the triangles around each vertex.
+
+    Parameters
+    ----------
+    tri : ndarray
+        n_tri X 3 indices of the vertices of each triangle
+    n_vert : int
+        number of vertices
+
+    Notes
+    -----
+    The triangle-incidence matrix (n_tri X n_vert) is computed only once, so
+    each iteration is a few sparse products. Triangles with at least one NaN
+    are ignored; vertices without any valid triangle keep their value.
+    """
+    def __init__(self, tri, n_vert):
+        tri = asarray(tri)
+        n_tri = tri.shape[0]
+        self.incidence = csr_matrix((ones(tri.size),
+                                     (repeat(arange(n_tri), tri.shape[1]),
+                                      tri.ravel())),
+                                    shape=(n_tri, n_vert))
+        self.n_per_tri = tri.shape[1]
+
+    def __call__(self, values, n_iter=1):
+        """Smooth the values.
+
+        Parameters
+        ----------
+        values : ndarray
+            values for each vertex (n_vert, or n_vert X n_values)
+        n_iter : int
+            number of times the smoothing is applied
+
+        Returns
+        -------
+        ndarray
+            smoothed values (NaN where values is NaN)
+        """
+        values = asarray(values, dtype=float)
+        for _ in range(n_iter):
+            values = self._smooth_once(values)
+        return values
+
+    def _smooth_once(self, values):
+        is_nan = isnan(values)
+        tri_valid = self.incidence.dot(is_nan.astype(float)) == 0
+        tri_mean = self.incidence.dot(where(is_nan, 0, values))
+        tri_mean = where(tri_valid, tri_mean / self.n_per_tri, 0)
+
+        total = self.incidence.T.dot(tri_mean)
+        n_tri = self.incidence.T.dot(tri_valid.astype(float))
+        with errstate(invalid='ignore', divide='ignore'):
+            return where(n_tri > 0, total / n_tri, values)
@@ -1,54 +1,78 @@
-from functools import partial
-from multiprocessing import Pool
-from numpy import (array,
+from hashlib import md5
+from pickle import dump, load
+
+from numpy import (add,
+                   append,
+                   arange,
+                   argmax,
+                   argsort,
+                   array,
                    c_,
+                   clip,
+                   corrcoef,
+                   cumsum,
+                   diff,
                    exp,
                    isfinite,
                    fill_diagonal,
-                   flipud,
+                   inf,
+                   linspace,
                    log,
+                   median,
                    min,
                    nanmean,
-                   NaN,
+                   nan,
                    r_,
+                   repeat,
+                   searchsorted,
                    seterr,
+                   sign,
                    sum,
+                   take_along_axis,
                    where,
                    zeros)
-from vispy.plot import Fig
-from vispy.scene.visuals import Image
 from vispy.io import write_png
 
 from .constants import (ALL_REREF,
                         COLORMAP,
+                        DATA_PATH,
+                        DIRECTION_FOLDER,
+                        DIR_MAT_PX,
                         DIR_MAT_RATIO,
                         DIR_SUMMARY_RATIO,
                         DIR_SUMMARY_MINCNT,
                         DIR_SURF_RATIO,
                         HEMI_SUBJ,
                         IMAGE_NAN_COLOR,
+                        PARAMETERS,
                         P_CORRECTION,
                         P_THRESHOLD,
+                        REGION_MAX_DIST,
                         SPINDLE_OPTIONS,
                         SURF_PLOT_SIZE)
 from .detect_spindles import get_spindles
+from .mixed_model import p_adjust
+from .plot_2d import heatmap_image
 from .plot_spindles import plot_lmer
-from .spindle_source import get_chan_with_regions, get_regions_with_elec
+from .render import FigureQueue
+from .spindle_source import get_region_codes, get_regions_with_elec
+from .stats_cache import cached_stats
 
 from .log import with_log
 
 
-from numpy import triu
-from numpy.random import binomial, seed
-from rpy2.robjects.numpy2ri import activate
-from rpy2.robjects import r
-
-activate()  # conversion R <-> numpy
-p_adjust = r['p.adjust']
+from numpy import swapaxes, triu_indices
+from numpy.random import RandomState
 
 
 NULL_PROBABILITY = .5
 N_RND = 10000
+NULL_MAX_BYTES = 2 ** 28  # max memory for one block of null matrices
+ADAPTIVE_NULL = True  # stop drawing once the significance cannot change
+ADAPTIVE_BLOCK = 500  # check if we can stop after these many permutations
+# bins for the onset lag of following spindles (the last bin is for the lags
+# longer than 2 s, so that all the pairs count for the median)
+LAG_BINS = append(linspace(0, 2, 41), inf)
 
 REGIONS = [
  'medialorbitofrontal_1',
@@ -97,6 +121,7 @@ def Direction_of_Spindles(lg, images_dir):
 
     lg.info('## Cooccurrence_of_Spindles')
 
+    figures = FigureQueue()
     for reref in ALL_REREF:
 
         lg.info('### reref {}'.format(reref))
@@ -105,33 +130,17 @@ def Direction_of_Spindles(lg, images_dir):
             regions = REGIONS
         else:
             regions = get_regions_with_elec(reref)
-        x = zeros((len(regions), len(regions)))
+        counts = {}
+        lags = {}
         for subj in HEMI_SUBJ:
-
-            spindles = get_spindles(subj, reref=reref, **SPINDLE_OPTIONS)
-            chan = get_chan_with_regions(subj, reref=reref)
-            chan_with_regions = dict(zip(spindles.chan_name,
-                                         chan.return_attr('region',
-                                                          spindles.chan_name)))
-
-            for sp0 in spindles.spindle:  # this is the lead
-                for sp1 in spindles.spindle:  # this is the follower
-
-                    if ((sp1['start_time'] > sp0['start_time']) and
-                        (sp1['start_time'] < sp0['end_time'])):
-
-                        region0 = chan_with_regions[sp0['chan']]
-                        region1 = chan_with_regions[sp1['chan']]
-                        try:
-                            i0 = regions.index(region0[7:])
-                            i1 = regions.index(region1[7:])
-                            x[i0, i1] += 1
-                        except ValueError:  # if it's not in the regions of interest
-                            pass
+            counts[subj], lags[subj] = get_direction_counts(subj, reref,
+                                                            regions)
+        x = _group_counts(counts)
+        lag_hist = _group_counts(lags)
 
         old_warnings = seterr(all="ignore")
 
-        _direction_summary(lg, x)
+        _direction_summary(lg, x, lag_hist)
 
         img = _make_direction_matrix(x)
 
@@ -145,18 +154,17 @@ def Direction_of_Spindles(lg, images_dir):
 
         coef = dict(zip(regions, d))
 
-        _partial_null = partial(_compute_null_direction, x)
+        _leave_one_out(lg, counts, d)
 
-        with Pool() as p:
-            n_d = p.map(_partial_null, range(N_RND))
-        n_d = r_[n_d]
+        key = ('direction', x, N_RND, NULL_PROBABILITY, ADAPTIVE_NULL,
+               ADAPTIVE_BLOCK, P_CORRECTION, P_THRESHOLD)
+        pv, n_used = cached_stats(key, _direction_pvalues, x, d, N_RND)
 
         lg.info('\nCorrected at {} {}'.format(P_CORRECTION, P_THRESHOLD))
-
-        uncorr_pv = min(c_[sum(d >= n_d, axis=0) / N_RND,
-                           sum(d <= n_d, axis=0) / N_RND], axis=1)
-        pv = array(p_adjust(uncorr_pv * 2,  # two-tailed
-                            method=P_CORRECTION))
+        lg.info('Random permutations per region: median {:.0f} (range {}-{})'
+                ''.format(median(n_used), min(n_used), n_used.max()))
+        for region, one_n in zip(regions, n_used):
+            lg.debug('{:30} {: 6d} permutations'.format(region, one_n))
 
         pvalues = dict(zip(regions, pv))
 
@@ -177,96 +185,451 @@ def Direction_of_Spindles(lg, images_dir):
         v = plot_lmer(coef, limits=limits, size_mm=SURF_PLOT_SIZE)
         png_name = 'direction_map_{}.png'.format(reref)
         png_file = str(images_dir.joinpath(png_name))
-        v.save(png_file)
+        figures.submit(v, png_file)
         lg.info('![{}]({})'.format('{}'.format(reref),
                 png_file))
 
         seterr(**old_warnings)
 
+    figures.run()
+
+
+def get_direction_counts(subj, reref, regions, lag_bins=LAG_BINS):
+    """Count the pairs of leading and following spindles between regions for
+    one subject. The counts are stored to disk, together with the spindle
+    options, the regions and the region of each channel they were computed
+    on.
+
+    Parameters
+    ----------
+    subj : str
+        subject code
+    reref : str or int
+        'avg' or 15, for average reference or bipolar montage
+    regions : list of str
+        regions of interest
+    lag_bins : ndarray
+        edges of the bins for the histogram of onset lags, in s
+
+    Returns
+    -------
+    ndarray
+        n_regions X n_regions matrix, where the first dimension is the region
+        of the leading spindle and the second dimension is the region of the
+        following spindle
+    ndarray
+        n_regions X n_regions X n_bins histogram of the onset lags (start time
+        of the following spindle minus start time of the leading spindle)
+    """
+    labels, codes, _ = get_region_codes(subj, reref, tuple(regions))
+
+    options = {'spindle_options': SPINDLE_OPTIONS,
+               'parc_type': PARAMETERS['PARC_TYPE'],
+               'region_max_dist': REGION_MAX_DIST,
+               'regions': tuple(regions),
+               'labels': tuple(str(x) for x in labels),
+               'codes': tuple(int(x) for x in codes),
+               'lag_bins': tuple(lag_bins),
+               }
+    options_hash = md5(repr(sorted(options.items())).encode()).hexdigest()
+
+    subj_dir = DATA_PATH / subj / DIRECTION_FOLDER
+    if not subj_dir.exists():
+        subj_dir.mkdir()
+    direction_file = subj_dir / ('direction_{}_{}_{}.pkl'
+                                 ''.format(subj, reref, options_hash[:10]))
+
+    if direction_file.exists():
+        with direction_file.open('rb') as f:
+            stored = load(f)
+        if stored['options'] == options:
+            return stored['x'], stored['lags']
+
+    spindles = get_spindles(subj, reref=reref, **SPINDLE_OPTIONS)
+    chan_codes = dict(zip(labels, codes))
+
+    x, lags = _count_leader_follower(spindles, chan_codes, len(regions),
+                                     lag_bins)
+
+    with direction_file.open('wb') as f:
+        dump({'options': options, 'x': x, 'lags': lags}, f)
+
+    return x, lags
+
+
+def _group_counts(counts, exclude=()):
+    """Sum the counts of the spindle pairs (or their onset lags) over
+    subjects.
+
+    Parameters
+    ----------
+    counts : dict
+        for each subject, the n_regions X n_regions matrix with the counts (or
+        the n_regions X n_regions X n_bins histogram of onset lags)
+    exclude : tuple of str
+        subjects to leave out
+
+    Returns
+    -------
+    ndarray
+        counts of the group
+    """
+    return sum([x for subj, x in counts.items() if subj not in exclude],
+               axis=0)
 
-def _make_direction_matrix(x):
-
-    from numpy import isnan
-    from phypno.viz.base import normalize
-    from vispy.color import get_colormap
 
-    cm = get_colormap(COLORMAP)
+def _leave_one_out(lg, counts, d):
+    """Check how much the direction summary depends on each subject.
 
-    c = log(x / x.T)
-    c[~isfinite(c)] = NaN
-    fill_diagonal(c, NaN)
-
-    # colormap only accepts column vector
-    val = flipud(c).reshape((-1, ))
-    val = normalize(val, -log(DIR_MAT_RATIO), log(DIR_MAT_RATIO))
-    clr = cm[val].rgba
-
-    # convert empty values to NaN color
-    hasnan = isnan(clr).all(axis=1)
-    clr[hasnan, :] = IMAGE_NAN_COLOR
-
-    # convert back to square matrix + color dimension
-    clr = clr.reshape((c.shape[0], c.shape[1], 4))
-
-    f = Fig()
-    plt = f[0, 0]
-    im = Image(clr)
-    plt.view.add(im)
-
-    plt.view.camera = 'panzoom'
-    plt.view.camera.aspect = 1
-    plt.view.camera.set_range()
-
-    region = (160, 34, 480, 479)
-    img = f.render(region)
-
-    """convert img to transparent, if IMAGE_NAN_COLOR has unique values
-    img_r = img.reshape(-1, 4)
-    nan_vxl = (img_r == (array(IMAGE_NAN_COLOR) * 255).astype('uint8')).all(axis=1)
-    img_r[nan_vxl, :] = array([0, 0, 0, 0])
-    img = img_r.reshape((img.shape[0], img.shape[1], 4))
+    Parameters
+    ----------
+    lg : instance of logging.Logger
+        logging template
+    counts : dict
+        for each subject, the n_regions X n_regions matrix with the counts
+    d : ndarray
+        direction summary for each region, computed on all the subjects
+    """
+    lg.info(' {:<10} {:<12} {:<17}'.format('Left out', 'Correlation',
+                                           '# Sign changes'))
+    lg.info('-' * 10 + ' ' + '-' * 12 + ' ' + '-' * 17 + ' ')
+
+    for subj in counts:
+        d_loo = _calc_dir_summary(_group_counts(counts, exclude=(subj, )))
+        both = isfinite(d) & isfinite(d_loo)
+        r = corrcoef(d[both], d_loo[both])[0, 1]
+        n_sign = sum(sign(d[both]) != sign(d_loo[both]))
+        lg.info('{:<10} {: 12.3f} {: 17d} '.format(subj, r, n_sign))
+
+    lg.info('\n')
+
+
+def _count_leader_follower(spindles, chan_codes, n_regions,
+                           lag_bins=LAG_BINS):
+    """Count how often a spindle in one region is followed by a spindle in
+    another region, which starts while the first one is still ongoing.
+
+    Parameters
+    ----------
+    spindles : instance of Spindles
+        spindles of one subject
+    chan_codes : dict
+        index of the region for each channel (-1 if the channel is not in the
+        regions of interest)
+    n_regions : int
+        number of regions of interest
+    lag_bins : ndarray
+        edges of the bins for the histogram of onset lags, in s
+
+    Returns
+    -------
+    ndarray
+        n_regions X n_regions matrix, where the first dimension is the region
+        of the leading spindle and the second dimension is the region of the
+        following spindle
+    ndarray
+        n_regions X n_regions X n_bins histogram of the onset lags (start time
+        of the following spindle minus start time of the leading spindle).
+        Like numpy.histogram, the last bin includes the right edge and lags
+        outside the bins are not counted (the last edge of LAG_BINS is inf, so
+        no lag is left out).
+
+    Notes
+    -----
+    Spindles are sorted by start time, so that the followers of each spindle
+    are the consecutive spindles whose start time falls between the start time
+    (excluded) and the end time (excluded) of the leading spindle.
     """
+    start_time = array([x['start_time'] for x in spindles.spindle])
+    end_time = array([x['end_time'] for x in spindles.spindle])
+    codes = array([chan_codes[x['chan']] for x in spindles.spindle],
+                  dtype=int)
+
+    i_sort = argsort(start_time, kind='mergesort')
+    start_time = start_time[i_sort]
+    end_time = end_time[i_sort]
+    codes = codes[i_sort]
+
+    i_first = searchsorted(start_time, start_time, side='right')
+    i_last = searchsorted(start_time, end_time, side='left')
+    n_follower = clip(i_last - i_first, 0, None)
+
+    leader = repeat(arange(len(start_time)), n_follower)
+    follower = (repeat(i_first, n_follower) + arange(n_follower.sum()) -
+                repeat(cumsum(n_follower) - n_follower, n_follower))
+
+    code0 = codes[leader]
+    code1 = codes[follower]
+    in_regions = (code0 >= 0) & (code1 >= 0)
+
+    x = zeros((n_regions, n_regions))
+    add.at(x, (code0[in_regions], code1[in_regions]), 1)
+
+    lag = (start_time[follower] - start_time[leader])[in_regions]
+    i_bin = searchsorted(lag_bins, lag, side='right') - 1
+    i_bin[lag == lag_bins[-1]] = len(lag_bins) - 2
+    in_bins = (i_bin >= 0) & (i_bin < len(lag_bins) - 1)
+
+    lags = zeros((n_regions, n_regions, len(lag_bins) - 1))
+    add.at(lags, (code0[in_regions][in_bins], code1[in_regions][in_bins],
+                  i_bin[in_bins]), 1)
+
+    return x, lags
 
-    return img
 
+def _make_direction_matrix(x):
+    """Image of the log-ratio of the spindle pairs between regions.
+
+    Parameters
+    ----------
+    x : ndarray
+        n_regions X n_regions matrix with the number of spindle pairs
+
+    Returns
+    -------
+    ndarray
+        image (RGBA, uint8), where region 0 is the top row
+    """
+    c = log(x / x.T)
+    c[~isfinite(c)] = nan
+    fill_diagonal(c, nan)
+
+    cell_px = max(1, DIR_MAT_PX // c.shape[0])
+    return heatmap_image(c, (-log(DIR_MAT_RATIO), log(DIR_MAT_RATIO)),
+                         COLORMAP, IMAGE_NAN_COLOR, cell_px=cell_px)
+
+
+def _direction_pvalues(x, d, n_rnd, adaptive=ADAPTIVE_NULL, seed_value=0):
+    """Compute the two-tailed p-values of the direction summary, corrected
+    for multiple comparisons, based on random splits of the spindle pairs.
+
+    Parameters
+    ----------
+    x : ndarray
+        n_regions X n_regions matrix with the number of spindle pairs
+    d : ndarray
+        direction summary for each region (computed on x)
+    n_rnd : int
+        (maximum) number of random splits
+    adaptive : bool
+        stop drawing random splits for one region, once its significance
+        (after correction) is the same whatever the remaining random splits
+    seed_value : int
+        seed for the random number generator
+
+    Returns
+    -------
+    ndarray
+        corrected p-value for each region (NaN for regions without pairs)
+    ndarray
+        number of random splits used for each region
+
+    Notes
+    -----
+    With adaptive, the significance of each region is identical to the one
+    obtained with all the n_rnd random splits, only the p-value of the regions
+    that were stopped early is estimated on fewer random splits. After each
+    block, the number of extreme values at the end of n_rnd random splits can
+    be anywhere between the current number (no more extreme values) and the
+    current number plus the random splits that are left (all the values are
+    extreme). The correction is monotonic, so if one region is significant
+    with the largest p-values of all the regions, or not significant with the
+    smallest p-values, it cannot change anymore.
+
+    The bounds are fixed (all or none of the random splits that are left are
+    extreme), not confidence bounds. Only the regions which are clearly not
+    significant stop early. A significant region stops only if its p-value is
+    below the threshold even when all the random splits left are extreme,
+    which never happens before the last block with the default N_RND and
+    ADAPTIVE_BLOCK (500 splits left give a p-value of at least .1).
+    """
+    rng = RandomState(seed_value)
+
+    n_high = zeros(d.shape, dtype=int)
+    n_low = zeros(d.shape, dtype=int)
+    n_used = zeros(d.shape, dtype=int)
+    active = isfinite(d)
+
+    if adaptive:
+        max_block = ADAPTIVE_BLOCK
+    else:
+        max_block = None
+
+    for n_block in _block_sizes(x, n_rnd, max_block):
+        n_d = _draw_null_block(x, n_block, rng, active)
+        n_high[active] += sum(d[active] >= n_d[:, active], axis=0)
+        n_low[active] += sum(d[active] <= n_d[:, active], axis=0)
+        n_used[active] += n_block
+
+        if adaptive:
+            active &= ~_is_decided(n_high, n_low, n_used, n_rnd)
+            if not active.any():
+                break
+
+    uncorr_pv = min(c_[n_high, n_low], axis=1) / n_used
+    uncorr_pv[~isfinite(d)] = nan
+    pv = p_adjust(uncorr_pv * 2, method=P_CORRECTION)  # two-tailed
+
+    return pv, n_used
+
+
+def _is_decided(n_high, n_low, n_used, n_rnd):
+    """Check which regions have a significance that cannot change anymore.
+
+    Parameters
+    ----------
+    n_high : ndarray
+        for each region, number of random values larger than the observed one
+    n_low : ndarray
+        for each region, number of random values smaller than the observed one
+    n_used : ndarray
+        for each region, number of random values (0 if not tested)
+    n_rnd : int
+        total number of random splits
+
+    Returns
+    -------
+    ndarray of bool
+        True for regions that do not need more random splits
+    """
+    n_extreme = min(c_[n_high, n_low], axis=1)
+    n_left = n_rnd - n_used
+
+    pv_lowest = n_extreme / n_rnd * 2
+    pv_highest = (n_extreme + n_left) / n_rnd * 2
+    pv_lowest[n_used == 0] = nan
+    pv_highest[n_used == 0] = nan
+
+    sign_at_best = p_adjust(pv_lowest, method=P_CORRECTION) < P_THRESHOLD
+    sign_at_worst = p_adjust(pv_highest, method=P_CORRECTION) < P_THRESHOLD
+
+    return (sign_at_best == sign_at_worst) | (n_left == 0)
+
+
+def _compute_null_direction(x, n_rnd, seed_value=0):
+    """Compute the null distribution of the direction summary, by splitting
+    at random the number of spindle pairs between two regions.
+
+    Parameters
+    ----------
+    x : ndarray
+        n_regions X n_regions matrix with the number of spindle pairs
+    n_rnd : int
+        number of random splits
+    seed_value : int
+        seed for the random number generator
+
+    Returns
+    -------
+    ndarray
+        n_rnd X n_regions matrix, with the direction summary for each random
+        split
+    """
+    rng = RandomState(seed_value)
+    n_d = [_draw_null_block(x, n_block, rng)
+           for n_block in _block_sizes(x, n_rnd)]
+
+    return r_[tuple(n_d)]
+
+
+def _block_sizes(x, n_rnd, max_block=None):
+    """Split the random splits into blocks, whose size depends on
+    NULL_MAX_BYTES (and max_block, if specified)."""
+    block_size = max(1, int(NULL_MAX_BYTES // (4 * x.nbytes)))
+    if max_block is not None and max_block < block_size:
+        block_size = max_block
+
+    return diff(r_[arange(0, n_rnd, block_size), n_rnd])
+
+
+def _draw_null_block(x, n_block, rng, regions=None):
+    """Draw one block of random splits.
+
+    Parameters
+    ----------
+    x : ndarray
+        n_regions X n_regions matrix with the number of spindle pairs
+    n_block : int
+        number of random splits
+    rng : instance of RandomState
+        random number generator
+    regions : ndarray of bool, optional
+        regions whose direction summary should be computed (if None, all of
+        them). Only the pairs including at least one of these regions are
+        split at random.
+
+    Returns
+    -------
+    ndarray
+        n_block X n_regions matrix, with the direction summary for each random
+        split (NaN for the regions that were not requested)
+
+    Notes
+    -----
+    All the binomial values of the block are drawn in one call.
+    """
+    i0, i1 = triu_indices(x.shape[0])
+    if regions is not None:
+        with_region = regions[i0] | regions[i1]
+        i0 = i0[with_region]
+        i1 = i1[with_region]
+    s_x = (x + x.T)[i0, i1].astype(int)
 
-def _compute_null_direction(x, seed_value):
-    s_x = triu(x + x.T)
+    b = rng.binomial(s_x, NULL_PROBABILITY, size=(n_block, len(s_x)))
 
-    seed(seed_value)
-    x2 = zeros(x.shape)
+    x2 = zeros((n_block, ) + x.shape)
+    x2[:, i0, i1] = b
+    x2[:, i1, i0] = s_x - b  # on the diagonal, this value is kept
 
-    for i0 in range(x.shape[0]):
-        for i1 in range(x.shape[1]):
-            if i0 <= i1:
-                b = binomial(s_x[i0, i1], NULL_PROBABILITY)
-                x2[i0, i1] = b
-                x2[i1, i0] = s_x[i0, i1] - b
+    n_d = _calc_dir_summary(x2)
+    if regions is not None:
+        n_d[:, ~regions] = nan
 
-    return _calc_dir_summary(x2)
+    return n_d
 
 
 def _calc_dir_summary(x):
+    """Compute the mean log-ratio of leading and following spindles.
+
+    Parameters
+    ----------
+    x : ndarray
+        n_regions X n_regions matrix (or an array of them, with the regions in
+        the last two dimensions)
+
+    Returns
+    -------
+    ndarray
+        mean log-ratio for each region
+    """
     # d = sum(x, axis=1) / (sum(x, axis=0) + sum(x, axis=1)) * 100
 
-    c = log(x / x.T)
-    c[~ isfinite(c)] = NaN
-    d = nanmean(c, axis=1)
+    c = log(x / swapaxes(x, -1, -2))
+    c[~ isfinite(c)] = nan
+    d = nanmean(c, axis=-1)
 
     return d
 
 
-def _direction_summary(lg, x):
+def _direction_summary(lg, x, lag_hist, lag_bins=LAG_BINS):
     """Create a table with the summary of the direction results"""
 
     c = log(x / x.T)
-    c[~isfinite(c)] = NaN
-    fill_diagonal(c, NaN)
+    c[~isfinite(c)] = nan
+    fill_diagonal(c, nan)
     cnt = x + x.T
+    lag = _median_lag(lag_hist, lag_bins)
+
+    n_long = lag_hist[..., ~isfinite(lag_bins[1:])].sum()
+    lg.info('Spindle pairs with onset lag longer than {} s: {:.0f} of {:.0f}'
+            ''.format(lag_bins[isfinite(lag_bins)][-1], n_long,
+                      lag_hist.sum()))
 
-    lg.info(' {:<30} {:<30} {:<17} {:<12}'
-            ''.format('From', 'To', '# Spindle Pairs', 'Ratio'))
-    lg.info('-' * 30 + ' ' + '-' * 30 + ' ' + '-' * 17 + ' ' + '-' * 12 + ' ')
+    lg.info(' {:<30} {:<30} {:<17} {:<12} {:<14}'
+            ''.format('From', 'To', '# Spindle Pairs', 'Ratio',
+                      'Median Lag (s)'))
+    lg.info('-' * 30 + ' ' + '-' * 30 + ' ' + '-' * 17 + ' ' + '-' * 12 + ' ' +
+            '-' * 14 + ' ')
 
     pairs = []
 
@@ -275,16 +638,52 @@ def _direction_summary(lg, x):
             one_pair = {'from': _rename_region(REGIONS[i0]),
                         'to': _rename_region(REGIONS[i1]),
                         'cnt': int(cnt[i0, i1]),
-                        'ratio': exp(c[i0, i1])}
+                        'ratio': exp(c[i0, i1]),
+                        'lag': lag[i0, i1]}
             pairs.append(one_pair)
 
     for one_pair in sorted(pairs, key=lambda k: k['ratio'], reverse=True):
-        lg.info('{from:<30} {to:<30}{cnt: 17d} {ratio: 10.3f}:1 '
+        lg.info('{from:<30} {to:<30}{cnt: 17d} {ratio: 10.3f}:1 {lag: 14.3f} '
                 ''.format(**one_pair))
 
     lg.info('\n')  # otherwise no figure in html
 
 
+def _median_lag(lag_hist, lag_bins=LAG_BINS):
+    """Compute the median onset lag from the histogram of onset lags.
+
+    Parameters
+    ----------
+    lag_hist : ndarray
+        n_regions X n_regions X n_bins histogram of the onset lags
+    lag_bins : ndarray
+        edges of the bins for the histogram of onset lags, in s
+
+    Returns
+    -------
+    ndarray
+        n_regions X n_regions matrix with the median onset lag, interpolated
+        linearly within each bin (NaN if there are no spindle pairs). If the
+        median falls in the bin without right edge, the result is the left
+        edge of that bin (so the median is at least that long).
+    """
+    cum_hist = cumsum(lag_hist, axis=-1)
+    half = cum_hist[..., -1:] / 2
+    bin_width = diff(lag_bins)
+    bin_width[~isfinite(bin_width)] = 0  # open bin: use its left edge
+
+    i_bin = argmax(cum_hist >= half, axis=-1)[..., None]
+    n_in_bin = take_along_axis(lag_hist, i_bin, axis=-1)
+    n_before = take_along_axis(cum_hist, i_bin, axis=-1) - n_in_bin
+    frac = (half - n_before) / n_in_bin
+
+    lag = lag_bins[i_bin] + frac * bin_width[i_bin]
+    lag = lag[..., 0]
+    lag[cum_hist[..., -1] == 0] = nan
+
+    return lag
+
+
 def _rename_region(s):
     s = ' ('.join(s.split('_')) + ')'
     s = s.replace('medial', 'medial ')
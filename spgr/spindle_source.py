@@ -1,20 +1,35 @@
 from collections import Counter
+from copy import deepcopy
+from functools import lru_cache
 from logging import getLogger
+from multiprocessing import cpu_count, Pool, RawArray, Value
 from pickle import load, dump
 from re import split
 
-from numpy import array, max, mean, min
+from numpy import (array,
+                   asarray,
+                   concatenate,
+                   errstate,
+                   eye,
+                   frombuffer,
+                   isfinite,
+                   load as load_npz,
+                   max,
+                   mean,
+                   median,
+                   min,
+                   nan,
+                   prod,
+                   savez)
+from scipy.sparse import csr_matrix
+from scipy.spatial import cKDTree
 
 from phypno import Data
-from phypno.attr import Freesurfer
-from phypno.attr.chan import assign_region_to_channels
 from phypno.source import Linear, Morph
 
 from .constants import (APARC_FOLDER,
                         PROJ_FOLDER,
                         DATA_PATH,
-                        REC_PATH,
-                        FS_FOLDER,
                         DEFAULT_HEMI,
                         HEMI_SUBJ,
                         CHAN_TYPE,
@@ -23,23 +38,196 @@ from .constants import (APARC_FOLDER,
                         SMOOTHING_STD,
                         SMOOTHING_THRESHOLD,
                         PARAMETERS,
+                        REGION_MAX_DIST,
+                        avg_surf,
                         )
 from .read_data import get_chan_used_in_analysis
+from .surfaces import HEMIS, get_surface, get_surface_labels
 
 
 lg = getLogger(__name__)
 
+_ACCUMULATOR = {}  # slot of the shared array of each process
+
 
 def get_morph_linear(subj, values, reref, to_surf='fsaverage'):
+    """Project the values of the channels onto the average surface.
+
+    Parameters
+    ----------
+    subj : str
+        subject code
+    values : ndarray
+        one value for each channel (n_chan), or n_chan X n_values to project
+        many values at once
+    reref : str or int
+        'avg' or 15, for average reference or bipolar montage
+    to_surf : str
+        name of the average surface
+
+    Returns
+    -------
+    ndarray
+        values on each vertex of the average surface (n_vert, or
+        n_vert X n_values), NaN for the vertices far from the channels
+    """
     lg.debug('Projecting values for {}'.format(subj))
 
+    proj, is_valid = get_projection(subj, reref, to_surf)
+    morphed = proj.dot(values)
+    morphed[~is_valid] = nan
+
+    return morphed
+
+
+def project_to_avg(all_values, reref, fun='mean', parallel=True):
+    """Project the values of many subjects onto the average surface and
+    combine them.
+
+    Parameters
+    ----------
+    all_values : dict
+        for each subject, the values of the channels (n_chan, or
+        n_chan X n_values)
+    reref : str or int
+        'avg' or 15, for average reference or bipolar montage
+    fun : str
+        'mean' (NaN where no subject has values) or 'sum' (0 where no
+        subject has values), ignoring NaN
+    parallel : bool
+        project the subjects in a pool of processes
+
+    Returns
+    -------
+    ndarray
+        combined values on each vertex of the average surface (n_vert, or
+        n_vert X n_values)
+
+    Notes
+    -----
+    Each process accumulates the sum and the number of valid values of the
+    subjects it projects in its own slot of a shared array, so that the
+    projected values are never copied between processes and never stacked
+    across subjects.
+    """
+    n_values = asarray(next(iter(all_values.values()))).shape[1:]
+    shape = (avg_surf.vert.shape[0], ) + n_values
+    args = [(subj, values, reref) for subj, values in all_values.items()]
+
+    if parallel:
+        n_workers = int(min((cpu_count(), len(args))))  # numpy min
+    else:
+        n_workers = 1
+
+    size = int(prod(shape))
+    buffer = RawArray('d', n_workers * 2 * size)
+    slot = Value('i', 0)
+
+    if parallel:
+        with Pool(n_workers, initializer=_init_accumulator,
+                  initargs=(buffer, n_workers, size, slot)) as p:
+            p.map(_accumulate_projection, args)
+    else:
+        _init_accumulator(buffer, n_workers, size, slot)
+        list(map(_accumulate_projection, args))
+
+    acc = frombuffer(buffer).reshape(n_workers, 2, size).sum(axis=0)
+    total = acc[0].reshape(shape)
+    n_valid = acc[1].reshape(shape)
+
+    if fun == 'mean':
+        with errstate(invalid='ignore'):
+            return total / n_valid  # NaN where n_valid is 0
+    elif fun == 'sum':
+        return total
+    else:
+        raise ValueError('Unknown function ' + fun)
+
+
+def _init_accumulator(buffer, n_workers, size, slot):
+    """Assign one slot of the shared array to this process."""
+    with slot.get_lock():
+        i_slot = slot.value
+        slot.value += 1
+    _ACCUMULATOR['acc'] = frombuffer(buffer).reshape(n_workers, 2,
+                                                     size)[i_slot]
+
+
+def _accumulate_projection(args):
+    """Project the values of one subject and add them to the slot of this
+    process."""
+    subj, values, reref = args
+    morphed = get_morph_linear(subj, values, reref).ravel()
+    is_valid = isfinite(morphed)
+
+    acc = _ACCUMULATOR['acc']
+    acc[0, is_valid] += morphed[is_valid]
+    acc[1, is_valid] += 1
+
+
+@lru_cache(maxsize=None)
+def get_projection(subj, reref, to_surf='fsaverage'):
+    """Compute the projection from the channels to the average surface (Linear
+    and then Morph) as one sparse matrix.
+
+    Parameters
+    ----------
+    subj : str
+        subject code
+    reref : str or int
+        'avg' or 15, for average reference or bipolar montage
+    to_surf : str
+        name of the average surface
+
+    Returns
+    -------
+    instance of scipy.sparse.csr_matrix
+        n_vert X n_chan matrix, where n_vert is the number of vertices of the
+        average surface
+    ndarray of bool
+        vertices of the average surface which receive values (the others
+        are NaN after the projection)
+
+    Notes
+    -----
+    Linear and Morph are both linear, so the matrix is computed by projecting
+    each channel with value one and the other channels with value zero. It is
+    computed only once for each subject and stored to disk.
+    """
     chan = get_chan_used_in_analysis(subj, 'sleep', CHAN_TYPE, reref=reref,
                                      **DATA_OPTIONS)
 
-    data = Data(values, chan=chan.return_label())
-    morphed_data = _reflect_to_avg(subj, data, chan, to_surf)
+    proj_filename = ('morph_linear_{}_chan{:03d}_std{:03d}_thr{:03d}_{}_{}'
+                     '.npz'.format(reref, chan.n_chan, SMOOTHING_STD,
+                                   SMOOTHING_THRESHOLD, to_surf, subj))
+    subj_dir = DATA_PATH / subj / PROJ_FOLDER
+    if not subj_dir.exists():
+        subj_dir.mkdir()
+    proj_file = subj_dir / proj_filename
 
-    return morphed_data
+    if proj_file.exists():
+        with load_npz(str(proj_file)) as f:
+            proj = csr_matrix((f['data'], f['indices'], f['indptr']),
+                              shape=tuple(f['shape']))
+            is_valid = f['is_valid']
+
+    else:
+        labels = chan.return_label()
+        columns = []
+        for one_column in eye(chan.n_chan):
+            data = Data(one_column, chan=labels)
+            columns.append(_reflect_to_avg(subj, data, chan, to_surf).data[0])
+        columns = array(columns).T
+
+        is_valid = isfinite(columns).all(axis=1)
+        columns[~is_valid] = 0
+        proj = csr_matrix(columns)
+
+        with open(str(proj_file), 'wb') as f:
+            savez(f, data=proj.data, indices=proj.indices, indptr=proj.indptr,
+                  shape=proj.shape, is_valid=is_valid)
+
+    return proj, is_valid
 
 
 def _reflect_to_avg(subj, data, chan, to_surf):
@@ -48,12 +236,11 @@ def _reflect_to_avg(subj, data, chan, to_surf):
     """
 
     if HEMI_SUBJ[subj] != DEFAULT_HEMI:
+        chan = deepcopy(chan)
         for one_chan in chan.chan:
             one_chan.xyz *= (-1, 1, 1)
 
-    fs = Freesurfer(str(REC_PATH.joinpath(subj).joinpath(FS_FOLDER)))
-    brain = fs.read_brain()
-    surf = getattr(brain, DEFAULT_HEMI)
+    surf = get_surface(subj, DEFAULT_HEMI)
 
     linear_filename = ('linear_chan{:03d}_std{:03d}_thr{:03d}_{}.pkl'
                        ''.format(chan.n_chan, SMOOTHING_STD,
@@ -71,12 +258,18 @@ def _reflect_to_avg(subj, data, chan, to_surf):
         with open(str(linear_file), 'wb') as f:
             dump(l, f)
 
-    m = Morph(surf, to_surf=to_surf, smooth=MORPH_SMOOTHING)
+    m = _get_morph(subj, to_surf)
     morphed_data = m(l(data))
 
     return morphed_data
 
 
+@lru_cache(maxsize=None)
+def _get_morph(subj, to_surf):
+    surf = get_surface(subj, DEFAULT_HEMI)
+    return Morph(surf, to_surf=to_surf, smooth=MORPH_SMOOTHING)
+
+
 def rejected_chan(lg, all_subj, good_chan, all_chan):
 
     n_good_chan = array([x.n_chan for x in good_chan])
@@ -107,7 +300,9 @@ def rejected_chan(lg, all_subj, good_chan, all_chan):
         chan = _assign_labels(subj, chan, PARAMETERS['PARC_TYPE'])
         regions = chan.return_attr('region')
         for region in regions:
-            all_regions.append(split('[-_]', region)[2])
+            if region.startswith('ctx'):
+                region = split('[-_]', region)[2]
+            all_regions.append(region)
 
     for region, n_elec in Counter(all_regions).most_common():
         lg.info(region + ': ' + str(n_elec))
@@ -121,8 +316,8 @@ def get_chan_with_regions(subj, reref, parc_type=None):
     orig_chan = get_chan_used_in_analysis(subj, 'sleep', CHAN_TYPE,
                                           reref=reref, **DATA_OPTIONS)
 
-    region_filename = ('{}_chan{:03d}_{}.pkl'
-                       ''.format(parc_type,
+    region_filename = ('{}_kdtree_dist{}_chan{:03d}_{}.pkl'
+                       ''.format(parc_type, REGION_MAX_DIST,
                                  orig_chan.n_chan, subj))
     subj_dir = DATA_PATH / subj / APARC_FOLDER
     if not subj_dir.exists():
@@ -140,6 +335,53 @@ def get_chan_with_regions(subj, reref, parc_type=None):
     return chan
 
 
+@lru_cache(maxsize=None)
+def get_region_codes(subj, reref, regions=None, parc_type=None):
+    """Map each channel to the index of its cortical region.
+
+    Parameters
+    ----------
+    subj : str
+        subject code
+    reref : str or int
+        'avg' or 15, for average reference or bipolar montage
+    regions : tuple of str, optional
+        regions of interest (without "ctx-?h-"). If None, it uses the cortical
+        regions of this subject, sorted alphabetically.
+    parc_type : str, optional
+        the type of parcellation
+
+    Returns
+    -------
+    ndarray of str
+        labels of the channels
+    ndarray of int
+        for each channel, the index of its region in regions (-1 if the
+        channel is not in a cortical region or not in the regions of interest)
+    tuple of str
+        the regions of interest
+
+    Notes
+    -----
+    The results are cached, so that the table is computed only once for each
+    subject.
+    """
+    chan = get_chan_with_regions(subj, reref, parc_type)
+
+    chan_regions = [x[7:] if x[:3] == 'ctx' else None
+                    for x in chan.return_attr('region')]
+    if regions is None:
+        regions = tuple(sorted(set(chan_regions) - {None, }))
+
+    region_idx = {region: i for i, region in enumerate(regions)}
+    codes = array([region_idx.get(x, -1) for x in chan_regions], dtype=int)
+    labels = array(chan.return_label())
+    codes.flags.writeable = False
+    labels.flags.writeable = False
+
+    return labels, codes, regions
+
+
 def _assign_labels(subj, chan, parc_type):
     """Subfunction to assign region labels to chan
 
@@ -155,19 +397,61 @@ def _assign_labels(subj, chan, parc_type):
     Returns
     -------
     instance of Channels
-        channels with the regions
+        channels with the regions (attribute 'region', "ctx-?h-" and the name
+        of the region, or 'Unknown') and the distance in mm to the closest
+        labelled vertex (attribute 'region_distance')
+
+    Notes
+    -----
+    Each channel gets the region of the closest vertex on the surface (both
+    hemispheres), if that is closer than REGION_MAX_DIST.
     """
-    if parc_type.startswith('aparc.laus'):
-        fs_lut_name = 'aparc.annot.' + parc_type.split('.')[-1] + '.ctab'
-        fs_lut = str(REC_PATH / subj / FS_FOLDER / 'label' / fs_lut_name)
-    else:
-        fs_lut = None
-    fs = Freesurfer(str(REC_PATH / subj / FS_FOLDER), fs_lut=fs_lut)
-    chan = assign_region_to_channels(chan, fs, parc_type=parc_type,
-                                     exclude_regions=('Unknown', ))
+    tree, vert_regions = _get_region_tree(subj, parc_type)
+    dist, idx = tree.query(chan.return_xyz())
+
+    for one_chan, one_dist, one_idx in zip(chan.chan, dist, idx):
+        if one_dist <= REGION_MAX_DIST:
+            one_chan.attr['region'] = vert_regions[one_idx]
+        else:
+            one_chan.attr['region'] = 'Unknown'
+        one_chan.attr['region_distance'] = one_dist
+
+    if len(dist):
+        lg.debug('{}: distance from labelled vertices median {:.2f}mm, '
+                 'max {:.2f}mm, {} channels too far'
+                 ''.format(subj, median(dist), dist.max(),
+                           (dist > REGION_MAX_DIST).sum()))
     return chan
 
 
+@lru_cache(maxsize=None)
+def _get_region_tree(subj, parc_type):
+    """KD-tree over the labelled vertices of both hemispheres of one subject.
+
+    Returns
+    -------
+    instance of scipy.spatial.cKDTree
+        tree with the coordinates of the labelled vertices
+    ndarray of str
+        region of each vertex in the tree (with "ctx-?h-")
+    """
+    all_vert = []
+    all_regions = []
+    for hemi in HEMIS:
+        vert = get_surface(subj, hemi).vert
+        labels, regions = get_surface_labels(subj, hemi, parc_type)
+
+        regions = array(['ctx-{}-{}'.format(hemi, x) for x in regions])
+        is_known = [x.lower() not in ('unknown', ) for x in regions]
+        labelled = (labels >= 0) & (labels < len(regions))
+        labelled[labelled] = array(is_known, dtype=bool)[labels[labelled]]
+
+        all_vert.append(vert[labelled])
+        all_regions.append(regions[labels[labelled]])
+
+    return cKDTree(concatenate(all_vert)), concatenate(all_regions)
+
+
 def get_regions_with_elec(reref='avg'):
     """Return the list of channels with at least one electrode.
 
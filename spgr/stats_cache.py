@@ -0,0 +1,63 @@
+"""Store the results of the statistical tests on disk, keyed by the hash of
+the data and of the options. It does not depend on R, so the steps which only
+use numpy can read the cached results without starting R.
+"""
+from hashlib import md5
+from logging import getLogger
+from pickle import dump, load
+
+from numpy import ndarray
+
+from .constants import STATS_PATH
+
+lg = getLogger(__name__)
+
+
+def cached_stats(key, compute, *args):
+    """Return the result of a statistical test, stored to disk based on the
+    hash of the key. If the data and the options did not change, the test is
+    not run again.
+
+    Parameters
+    ----------
+    key : tuple
+        everything that determines the result of the test (the first element
+        is used as name of the file). Arrays are hashed by their content.
+    compute : function
+        function which runs the test
+    *args
+        arguments passed to compute
+
+    Returns
+    -------
+    any
+        output of compute
+    """
+    key_hash = _hash_key(key)
+    stats_file = STATS_PATH / '{}_{}.pkl'.format(key[0], key_hash[:16])
+
+    if stats_file.exists():
+        with stats_file.open('rb') as f:
+            stored = load(f)
+        if stored['key'] == key_hash:
+            lg.debug('Reading stats from ' + str(stats_file))
+            return stored['result']
+
+    result = compute(*args)
+
+    with stats_file.open('wb') as f:
+        dump({'key': key_hash, 'result': result}, f)
+
+    return result
+
+
+def _hash_key(key):
+    """md5 of a tuple with str, numbers and arrays."""
+    h = md5()
+    for one in key:
+        if isinstance(one, ndarray):
+            h.update(repr((one.shape, one.dtype.str)).encode())
+            h.update(one.tobytes())
+        else:
+            h.update(repr(one).encode())
+    return h.hexdigest()
@@ -1,23 +1,30 @@
 from logging import getLogger
 
 from numpy import (arange,
+                   argsort,
+                   array,
+                   bincount,
+                   ceil,
                    concatenate,
+                   cumsum,
+                   floor,
                    mean,
                    median,
-                   percentile,
-                   where,
+                   nan,
+                   r_,
+                   searchsorted,
                    zeros)
 from scipy.stats import ttest_rel
 
-from .constants import (DATA_OPTIONS,
+from .constants import (N_PERMUTATIONS,
                         PARAMETERS,
                         SPINDLE_OPTIONS)
 from .detect_spindles import get_spindles
 from .read_data import keep_time_chan
+from .resampling import sign_flip_test
 
 lg = getLogger('spgr')
 PERCENT = PARAMETERS['PERCENTILE']
-S_FREQ = DATA_OPTIONS['resample_freq']
 
 
 def count_sp_at_any_time(sp, t_range):
@@ -29,20 +36,37 @@ def count_sp_at_any_time(sp, t_range):
     sp : instance of Spindles
         spindles to analyze
     t_range : ndarray vector
-        vector of actual time point in the recordings
+        vector of actual time point in the recordings (sorted in time, such as
+        one segment or the concatenation of consecutive segments)
 
     Returns
     -------
     ndarray vector
         same size as t_range, for each time point it tells you how many
         spindles there are
+
+    Notes
+    -----
+    Each spindle covers the time points between start_time (included) and
+    end_time (excluded). Instead of comparing each spindle with every time
+    point, we mark where each spindle starts and ends and take the cumulative
+    sum.
     """
-    t_in = zeros(t_range.shape, dtype=int)
-    for one_sp in sp.spindle:
-        t_in += ((t_range >= one_sp['start_time']) &
-                 (t_range < one_sp['end_time'])).astype(int)
+    start_time, end_time, _ = _spindle_times(sp)
+    return _count_in_segment(start_time, end_time, t_range)
+
+
+def _count_in_segment(start_time, end_time, t_range):
+    """Number of spindles at each time point (see count_sp_at_any_time), from
+    the start and end time of the spindles."""
+    n_time = len(t_range)
+    i_start = searchsorted(t_range, start_time, side='left')
+    i_end = searchsorted(t_range, end_time, side='left')
+
+    t_in = (bincount(i_start, minlength=n_time + 1) -
+            bincount(i_end, minlength=n_time + 1))
 
-    return t_in
+    return cumsum(t_in)[:-1]
 
 
 def count_cooccur_per_chan(subj, reref, summarize='mean'):
@@ -112,20 +136,39 @@ def get_cooccur_percent(subj, reref, lg):
         summary parameters for isolated spindles
     dict
         summary parameters for cooccurring spindles
+
+    Notes
+    -----
+    Only the time points in the segments that were analyzed (f.e. NREM2) are
+    used, one segment at the time. The gaps between segments are never part of
+    the distribution.
     """
     spindles = get_spindles(subj, reref=reref, **SPINDLE_OPTIONS)
-    t = [x['start_time'] for x in spindles.spindle]
-    t_range = arange(min(t), max(t), 1 / S_FREQ)
-    p = count_sp_at_any_time(spindles, t_range)
+    time = keep_time_chan(subj, reref)[0]
+
+    start_time, end_time, order = _spindle_times(spindles)
+    max_dur = (end_time - start_time).max(initial=0)
+    segments = [_segment_slice(start_time, max_dur, one_time)
+                for one_time in time]
+    p = [_count_in_segment(start_time[i], end_time[i], one_time)
+         for i, one_time in zip(segments, time)]
+
+    # number of time points for each level of cooccurrence
+    n_levels = max(one_p.max(initial=0) for one_p in p) + 1
+    p_hist = sum(bincount(one_p, minlength=n_levels) for one_p in p)
+    p_hist[0] = 0  # only time points with at least one spindle
 
     lg.info('{}'.format(subj))
-    df_i = _compute_percent(lg, spindles, t_range, p, 'isolated')
-    df_c = _compute_percent(lg, spindles, t_range, p, 'cooccurring')
+    sp_times = start_time, end_time, order, segments
+    df_i = _compute_percent(lg, spindles, sp_times, time, p, p_hist,
+                            'isolated')
+    df_c = _compute_percent(lg, spindles, sp_times, time, p, p_hist,
+                            'cooccurring')
 
     return df_i, df_c
 
 
-def _compute_percent(lg, spindles, t_range, p, sp_type):
+def _compute_percent(lg, spindles, sp_times, time, p, p_hist, sp_type):
     """Compute summary parameters for isolated and cooccurring spindles
 
     Parameters
@@ -134,11 +177,17 @@ def _compute_percent(lg, spindles, t_range, p, sp_type):
         logger to write to
     spindles : instance of Spindles
         spindles for one specific subject
-    t_range : ndarray
-        vector with all the possible time points (even those with no spindles,
-        it doesn't matter)
-    p : ndarray (same length as t_range)
-        number of spindles in each time point
+    sp_times : tuple
+        start time and end time of the spindles (sorted by start time), order
+        of the spindles and, for each segment, the slice of the spindles which
+        can overlap with it
+    time : list of ndarray
+        for each segment, the time points that were analyzed
+    p : list of ndarray (same length as time)
+        for each segment, number of spindles in each time point
+    p_hist : ndarray
+        number of time points for each number of spindles (the first value,
+        time points without spindles, should be zero)
     sp_type : str
         'isolated' or 'cooccurring'
 
@@ -149,17 +198,24 @@ def _compute_percent(lg, spindles, t_range, p, sp_type):
     dict
         summary parameters for cooccurring spindles
     """
-    p_with = p[p >= 1]
+    levels = arange(len(p_hist))
     if sp_type == 'isolated':
-        p_pool = where((p <= percentile(p_with, PERCENT)) & p >= 1)[0]
+        threshold = _percentile_from_hist(p_hist, PERCENT)
+        selected = (levels <= threshold) & (levels >= 1)
     elif sp_type == 'cooccurring':
-        p_pool = where((p >= percentile(p_with, 100 - PERCENT)))[0]
-    i_t = t_range[p_pool]
+        threshold = _percentile_from_hist(p_hist, 100 - PERCENT)
+        selected = levels >= threshold
+
+    start_time, end_time, order, segments = sp_times
 
-    all_sp = []
-    for sp in spindles.spindle:
-        if any((sp['start_time'] <= i_t) & (sp['end_time'] >= i_t)):
-            all_sp.append(sp)
+    in_pool = zeros(len(spindles.spindle), dtype=bool)
+    for i, one_time, one_p in zip(segments, time, p):
+        n_selected = r_[0, cumsum(selected[one_p])]
+        i_start = searchsorted(one_time, start_time[i], side='left')
+        i_end = searchsorted(one_time, end_time[i], side='right')
+        in_pool[i] |= (n_selected[i_end] - n_selected[i_start]) > 0
+
+    all_sp = [spindles.spindle[i] for i in order[in_pool]]
 
     lg.info('Number of {} spindles: {}'.format(sp_type, len(all_sp)))
 
@@ -171,6 +227,34 @@ def _compute_percent(lg, spindles, t_range, p, sp_type):
     return df
 
 
+def _percentile_from_hist(hist, q):
+    """Compute the percentile of integer values from their histogram.
+
+    Parameters
+    ----------
+    hist : ndarray
+        number of occurrences of each integer value (0, 1, 2, ...)
+    q : float
+        percentile, between 0 and 100
+
+    Returns
+    -------
+    float
+        percentile, identical to numpy.percentile on the values (with linear
+        interpolation), NaN if there are no values
+    """
+    if hist.sum() == 0:
+        return nan
+
+    cum_hist = cumsum(hist)
+    k = (cum_hist[-1] - 1) * q / 100
+    # value at position i of the sorted values
+    v_lo = searchsorted(cum_hist, floor(k), side='right')
+    v_hi = searchsorted(cum_hist, ceil(k), side='right')
+
+    return v_lo + (v_hi - v_lo) * (k - floor(k))
+
+
 def print_table_percent(lg, df_i, df_c):
     """Print summary tables for statistics on the top and bottom cooccurring
     spindles.
@@ -188,12 +272,44 @@ def print_table_percent(lg, df_i, df_c):
     """
     params = 'freq', 'ampl', 'dur'
 
-    for param in params:
-        i_val = [x[param] for x in df_i]
-        c_val = [x[param] for x in df_c]
-        tstat, pvalue = ttest_rel(i_val, c_val)
+    i_val = array([[x[param] for param in params] for x in df_i])
+    c_val = array([[x[param] for param in params] for x in df_c])
+    tstat, pvalues = ttest_rel(i_val, c_val)
+    _, perm_pvalues = sign_flip_test(i_val - c_val, correction='none')
+
+    for i, param in enumerate(params):
         lg.info('with param{:>5}, {:d}% most isolated spindles: {:.3f}, '
                 '{:d}% most cooccurring spindles: {:.3f}\n'
-                'paired t({:d}) = {:.3f}, p-value = {:.3f}'
-                ''.format(param, PERCENT, mean(i_val), PERCENT, mean(c_val),
-                          len(i_val) - 1, tstat, pvalue))
+                'paired t({:d}) = {:.3f}, p-value = {:.3f} '
+                '(sign-flip p-value = {:.3f}, {} sign flips)'
+                ''.format(param, PERCENT, mean(i_val[:, i]), PERCENT,
+                          mean(c_val[:, i]), len(i_val) - 1, tstat[i],
+                          pvalues[i], perm_pvalues[i], N_PERMUTATIONS))
+
+
+def _spindle_times(sp):
+    """Start and end time of the spindles, sorted by start time.
+
+    Returns
+    -------
+    ndarray
+        start time of each spindle
+    ndarray
+        end time of each spindle
+    ndarray of int
+        index of each spindle in sp.spindle
+    """
+    start_time = array([x['start_time'] for x in sp.spindle])
+    end_time = array([x['end_time'] for x in sp.spindle])
+    order = argsort(start_time, kind='stable')
+    return start_time[order], end_time[order], order
+
+
+def _segment_slice(start_time, max_dur, t_range):
+    """Slice of the spindles (sorted by start time) which can overlap with one
+    segment. Spindles which start earlier than max_dur before the segment end
+    before it, so they are not part of it."""
+    if len(t_range) == 0:
+        return slice(0, 0)
+    return slice(searchsorted(start_time, t_range[0] - max_dur, side='left'),
+                 searchsorted(start_time, t_range[-1], side='right'))
@@ -0,0 +1,141 @@
+"""Store the Freesurfer surfaces of each subject as binary arrays, so that they
+are parsed only once and then memory-mapped by projection, region assignment
+and plotting.
+"""
+from functools import lru_cache
+from logging import getLogger
+
+from numpy import array, load, save
+
+from phypno.attr import Freesurfer
+
+from .constants import (DATA_PATH,
+                        FS_FOLDER,
+                        PARAMETERS,
+                        REC_PATH,
+                        SURF_FOLDER,
+                        )
+
+lg = getLogger(__name__)
+
+HEMIS = ('lh', 'rh')
+
+
+class Surface:
+    """Surface with memory-mapped vertices and triangles. It has the same
+    attributes as phypno.attr.anat.Surf, so it can be used in its place.
+
+    Parameters
+    ----------
+    surf_file : str
+        path to the original Freesurfer surface
+    vert : ndarray
+        n_vert X 3 coordinates of the vertices
+    tri : ndarray
+        n_tri X 3 indices of the vertices of each triangle
+    """
+    def __init__(self, surf_file, vert, tri):
+        self.surf_file = surf_file
+        self.vert = vert
+        self.tri = tri
+
+    @property
+    def n_vert(self):
+        return self.vert.shape[0]
+
+
+@lru_cache(maxsize=None)
+def get_surface(subj, hemi):
+    """Read the surface of one hemisphere of one subject.
+
+    Parameters
+    ----------
+    subj : str
+        subject code
+    hemi : str
+        'lh' or 'rh'
+
+    Returns
+    -------
+    instance of Surface
+        the surface (vertices and triangles are read-only memmaps)
+
+    Notes
+    -----
+    The first time, the surfaces of both hemispheres are read with Freesurfer
+    and stored in the subject folder. The results are cached, so that all the
+    functions share the same arrays.
+    """
+    surf_dir = _surf_dir(subj)
+    if not (surf_dir / (hemi + '_tri.npy')).exists():
+        lg.debug('Storing surfaces of ' + subj)
+        brain = _freesurfer(subj).read_brain()
+        for one_hemi in HEMIS:
+            surf = getattr(brain, one_hemi)
+            save(str(surf_dir / (one_hemi + '_file.npy')),
+                 array(str(surf.surf_file)))
+            save(str(surf_dir / (one_hemi + '_vert.npy')), surf.vert)
+            save(str(surf_dir / (one_hemi + '_tri.npy')), surf.tri)
+
+    surf_file = str(load(str(surf_dir / (hemi + '_file.npy'))))
+    vert = load(str(surf_dir / (hemi + '_vert.npy')), mmap_mode='r')
+    tri = load(str(surf_dir / (hemi + '_tri.npy')), mmap_mode='r')
+
+    return Surface(surf_file, vert, tri)
+
+
+@lru_cache(maxsize=None)
+def get_surface_labels(subj, hemi, parc_type=None):
+    """Read the parcellation of one hemisphere of one subject.
+
+    Parameters
+    ----------
+    subj : str
+        subject code
+    hemi : str
+        'lh' or 'rh'
+    parc_type : str, optional
+        the type of parcellation (if None, the one in PARAMETERS)
+
+    Returns
+    -------
+    ndarray of int
+        for each vertex, the index of its region (read-only memmap)
+    ndarray of str
+        names of the regions
+    """
+    if parc_type is None:
+        parc_type = PARAMETERS['PARC_TYPE']
+
+    surf_dir = _surf_dir(subj)
+    labels_file = surf_dir / '{}_labels_{}.npy'.format(hemi, parc_type)
+    regions_file = surf_dir / '{}_regions_{}.npy'.format(hemi, parc_type)
+    if not labels_file.exists():
+        fs = _freesurfer(subj, parc_type)
+        labels, _, regions = fs.read_label(hemi, parc_type=parc_type)
+        save(str(labels_file), labels)
+        save(str(regions_file), array(regions, dtype=str))
+
+    labels = load(str(labels_file), mmap_mode='r')
+    regions = load(str(regions_file))
+
+    return labels, regions
+
+
+def _freesurfer(subj, parc_type=None):
+    """Freesurfer of one subject, with the lookup table of the parcellation
+    (only the aparc.laus parcellations have their own).
+    """
+    if parc_type is not None and parc_type.startswith('aparc.laus'):
+        fs_lut_name = 'aparc.annot.' + parc_type.split('.')[-1] + '.ctab'
+        fs_lut = str(REC_PATH / subj / FS_FOLDER / 'label' / fs_lut_name)
+    else:
+        fs_lut = None
+    return Freesurfer(str(REC_PATH / subj / FS_FOLDER), fs_lut=fs_lut)
+
+
+def _surf_dir(subj):
+    surf_dir = DATA_PATH / subj / SURF_FOLDER
+    if not surf_dir.exists():
+        surf_dir.mkdir()
+    return surf_dir
@@ -0,0 +1,74 @@
+"""Make spgr importable without the recordings and without the optional
+packages.
+
+spgr.constants reads parameters.json from the home folder, so HOME points to
+a temporary folder with the parameters that the modules read at import time.
+phypno, vispy and matplotlib, when they are not installed, are replaced by
+empty modules: the tests only use the numerical functions, which do not call
+them. The average brain of the stub of Freesurfer has no regions.
+"""
+from importlib.abc import Loader, MetaPathFinder
+from importlib.machinery import ModuleSpec
+from importlib.util import find_spec
+from json import dump
+from os import environ
+from pathlib import Path
+from sys import meta_path
+from tempfile import mkdtemp
+from unittest.mock import MagicMock
+
+from numpy import empty
+
+PARAMETERS = {'SPINDLE_OPTIONS': {},
+              'DPI': 100,
+              'COLORMAP': 'coolwarm',
+              'HIGHLIGHT_COLOR': 'y',
+              'PARC_TYPE': 'aparc',
+              'PERCENTILE': 10,
+              }
+STUBS = tuple(x for x in ('phypno', 'vispy', 'matplotlib')
+              if find_spec(x) is None)
+
+
+class Freesurfer:
+    """Freesurfer with one empty surface, used when phypno is missing."""
+    def __init__(self, freesurfer_dir, fs_lut=None):
+        self.dir = freesurfer_dir
+
+    def read_brain(self):
+        brain = MagicMock()
+        brain.lh = brain.rh = MagicMock(vert=empty((0, 3)),
+                                        tri=empty((0, 3), dtype=int))
+        return brain
+
+    def read_label(self, hemi, parc_type=None):
+        return empty(0, dtype=int), None, []
+
+
+class StubFinder(MetaPathFinder, Loader):
+    """Import the missing packages (and all their submodules) as mocks."""
+    def find_spec(self, name, path, target=None):
+        if name.split('.')[0] in STUBS:
+            return ModuleSpec(name, self, is_package=True)
+
+    def create_module(self, spec):
+        module = MagicMock()
+        module.__name__ = spec.name
+        module.__spec__ = spec
+        module.__path__ = []
+        if spec.name == 'phypno.attr':
+            module.Freesurfer = Freesurfer
+        return module
+
+    def exec_module(self, module):
+        pass
+
+
+home = Path(mkdtemp())
+environ['HOME'] = str(home)
+parameters_dir = home / 'projects' / 'spgr' / 'scripts' / 'spgr'
+parameters_dir.mkdir(parents=True)
+with open(str(parameters_dir / 'parameters.json'), 'w') as f:
+    dump(PARAMETERS, f)
+
+meta_path.insert(0, StubFinder())
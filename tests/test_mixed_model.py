@@ -0,0 +1,43 @@
+from numpy import arange, array, nan, repeat
+from numpy.testing import assert_allclose
+
+from spgr.mixed_model import fit_random_intercept, p_adjust
+
+
+# two conditions in each of 6 groups, with a random intercept per group
+X = array([[1, 0], [0, 1]] * 12, dtype=float)
+GROUP = repeat(arange(6), 4)
+Y = array([2.89, 3.34, 2.36, 3.62, 1.39, 3.05, 1.70, 2.38, 2.00, 2.95, 2.53,
+           2.68, 2.95, 3.37, 1.52, 4.12, 2.93, 3.12, 3.63, 2.77, 0.24, 1.12,
+           0.98, 1.95])
+
+
+def test_fit_random_intercept():
+    beta, cov_beta, sd_group, sd_resid = fit_random_intercept(X, GROUP, Y)
+
+    # REML fit of statsmodels.MixedLM(Y, X, groups=GROUP)
+    assert_allclose(beta, [2.093333, 2.8725], atol=1e-6)
+    assert_allclose(cov_beta, [[0.115091, 0.091243],
+                               [0.091243, 0.115091]], atol=1e-5)
+    assert_allclose(sd_group, 0.739905, atol=1e-5)
+    assert_allclose(sd_resid, 0.534956, atol=1e-5)
+
+
+def test_fit_random_intercept_many_responses():
+    y = array([Y, 2 * Y]).T
+    beta, cov_beta, sd_group, sd_resid = fit_random_intercept(X, GROUP, y)
+
+    assert beta.shape == (2, 2)
+    assert cov_beta.shape == (2, 2, 2)
+    assert_allclose(beta[1], 2 * beta[0])
+    assert_allclose(sd_resid[1], 2 * sd_resid[0], rtol=1e-5)
+
+
+def test_p_adjust():
+    pvalues = [.01, .04, .03, nan, .005]
+
+    # p.adjust in R
+    assert_allclose(p_adjust(pvalues, 'fdr'), [.02, .04, .04, nan, .02])
+    assert_allclose(p_adjust(pvalues, 'holm'), [.03, .06, .06, nan, .02])
+    assert_allclose(p_adjust(pvalues, 'bonferroni'),
+                    [.04, .16, .12, nan, .02])
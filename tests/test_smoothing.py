@@ -0,0 +1,70 @@
+from numpy import array, isnan, mean, nan, zeros
+from numpy.random import RandomState
+from numpy.testing import assert_allclose
+
+from spgr.smoothing import MeshSmoother
+
+
+def _random_mesh(n_vert, n_tri, seed_value=0):
+    rng = RandomState(seed_value)
+    tri = array([rng.choice(n_vert, 3, replace=False) for _ in range(n_tri)])
+    values = rng.randn(n_vert)
+    values[rng.choice(n_vert, 5, replace=False)] = nan
+    return tri, values
+
+
+def _smooth_loop(tri, values):
+    """Average of the valid triangles around each vertex, one by one."""
+    tri_mean = {}
+    for i, one_tri in enumerate(tri):
+        if not any(isnan(values[one_tri])):
+            tri_mean[i] = mean(values[one_tri])
+
+    smoothed = values.copy()
+    for i_vert in range(len(values)):
+        around = [tri_mean[i] for i, one_tri in enumerate(tri)
+                  if i_vert in one_tri and i in tri_mean]
+        if around:
+            smoothed[i_vert] = mean(around)
+    return smoothed
+
+
+def _smooth_loop_in_place(tri, values):
+    """Smoothing in plot_surf before MeshSmoother."""
+    values = values.copy()
+    for one_tri in tri:
+        if not any(isnan(values[one_tri])):
+            values[one_tri] = mean(values[one_tri])
+    return values
+
+
+def test_mesh_smoother():
+    tri, values = _random_mesh(40, 60)
+    smooth = MeshSmoother(tri, len(values))
+
+    assert_allclose(smooth(values), _smooth_loop(tri, values))
+    assert_allclose(smooth(values, n_iter=3),
+                    _smooth_loop(tri, _smooth_loop(tri,
+                                                   _smooth_loop(tri, values))))
+
+
+def test_mesh_smoother_many_values():
+    tri, values = _random_mesh(40, 60)
+    smooth = MeshSmoother(tri, len(values))
+
+    many_values = zeros((len(values), 2))
+    many_values[:, 0] = values
+    many_values[:, 1] = 2 * values
+    smoothed = smooth(many_values)
+
+    assert_allclose(smoothed[:, 0], smooth(values))
+    assert_allclose(smoothed[:, 1], 2 * smooth(values))
+
+
+def test_mesh_smoother_separate_triangles():
+    # the order of the triangles matters only when they share vertices
+    tri = array([[0, 1, 2], [3, 4, 5], [6, 7, 8]])
+    values = array([1, 2, 3, 4, nan, 6, 7, 8, 12.])
+
+    assert_allclose(MeshSmoother(tri, len(values))(values),
+                    _smooth_loop_in_place(tri, values))
@@ -0,0 +1,150 @@
+from numpy import array, c_, errstate, histogram, isfinite, min, sum, zeros
+from numpy.random import RandomState
+from numpy.testing import assert_allclose, assert_array_equal
+
+from spgr import spindle_direction
+
+
+class FakeSpindles:
+    def __init__(self, spindle):
+        self.spindle = spindle
+
+
+def _random_spindles(n_spindles, chans, seed_value=0):
+    rng = RandomState(seed_value)
+    start_time = rng.randint(0, 200, n_spindles) / 10  # with ties
+    duration = rng.randint(5, 30, n_spindles) / 10
+    chan = rng.choice(chans, n_spindles)
+    return [{'chan': c, 'start_time': s, 'end_time': s + d}
+            for c, s, d in zip(chan, start_time, duration)]
+
+
+def _count_double_loop(spindles, chan_codes, n_regions, lag_bins):
+    """Original implementation, which compares all the pairs of spindles."""
+    x = zeros((n_regions, n_regions))
+    lags = zeros((n_regions, n_regions, len(lag_bins) - 1))
+    for sp0 in spindles.spindle:  # this is the lead
+        for sp1 in spindles.spindle:  # this is the follower
+
+            if ((sp1['start_time'] > sp0['start_time']) and
+                    (sp1['start_time'] < sp0['end_time'])):
+
+                i0 = chan_codes[sp0['chan']]
+                i1 = chan_codes[sp1['chan']]
+                if i0 >= 0 and i1 >= 0:
+                    x[i0, i1] += 1
+                    lag = sp1['start_time'] - sp0['start_time']
+                    lags[i0, i1] += histogram([lag], bins=lag_bins)[0]
+
+    return x, lags
+
+
+def test_count_leader_follower():
+    chan_codes = {'a': 0, 'b': 1, 'c': 1, 'd': 2, 'e': -1}
+    spindles = FakeSpindles(_random_spindles(300, list(chan_codes)))
+    lag_bins = spindle_direction.LAG_BINS
+
+    x, lags = spindle_direction._count_leader_follower(spindles, chan_codes,
+                                                       3, lag_bins)
+    x_loop, lags_loop = _count_double_loop(spindles, chan_codes, 3, lag_bins)
+
+    assert x.sum() > 0
+    assert_array_equal(x, x_loop)
+    assert_array_equal(lags, lags_loop)
+    assert_array_equal(lags.sum(axis=2), x)
+
+
+def _random_counts(n_regions, seed_value=0):
+    x = RandomState(seed_value).poisson(20, (n_regions, n_regions))
+    x[0, 1] = x[1, 0] = 0  # one pair of regions without spindle pairs
+    return x.astype(float)
+
+
+def _null_loop(x, n_rnd, seed_value=0):
+    """Original implementation, with one random split at a time."""
+    rng = RandomState(seed_value)
+    s_x = x + x.T
+    n_d = []
+    for _ in range(n_rnd):
+        x2 = zeros(x.shape)
+        for i0 in range(x.shape[0]):
+            for i1 in range(x.shape[1]):
+                if i0 <= i1:
+                    b = rng.binomial(s_x[i0, i1], .5)
+                    x2[i0, i1] = b
+                    x2[i1, i0] = s_x[i0, i1] - b
+        n_d.append(spindle_direction._calc_dir_summary(x2))
+    return array(n_d)
+
+
+def test_compute_null_direction(monkeypatch):
+    x = _random_counts(5)
+
+    with errstate(all='ignore'):
+        n_d_loop = _null_loop(x, 50)
+        n_d = spindle_direction._compute_null_direction(x, 50)
+        # blocks of 3 random splits
+        monkeypatch.setattr(spindle_direction, 'NULL_MAX_BYTES',
+                            3 * 4 * x.nbytes)
+        n_d_blocks = spindle_direction._compute_null_direction(x, 50)
+
+    assert_allclose(n_d, n_d_loop)
+    assert_allclose(n_d_blocks, n_d_loop)
+
+
+def test_direction_pvalues():
+    x = _random_counts(5)
+
+    with errstate(all='ignore'):
+        d = spindle_direction._calc_dir_summary(x)
+        n_d = spindle_direction._compute_null_direction(x, 200)
+        pv, n_used = spindle_direction._direction_pvalues(x, d, 200,
+                                                          adaptive=False)
+
+    # p-values computed on the whole null distribution
+    uncorr_pv = min(c_[sum(d >= n_d, axis=0) / 200,
+                       sum(d <= n_d, axis=0) / 200], axis=1)
+    pv_all = spindle_direction.p_adjust(uncorr_pv * 2,
+                                        method=spindle_direction.P_CORRECTION)
+
+    assert isfinite(d).all()
+    assert_array_equal(n_used, 200)
+    assert_allclose(pv, pv_all)
+
+
+def test_is_decided():
+    # fdr correction of 3 regions (the last one is not tested)
+    n_high = array([0, 400, 10, 0])
+    n_low = array([5, 590, 480, 0])
+    n_used = array([990, 990, 500, 0])
+
+    decided = spindle_direction._is_decided(n_high, n_low, n_used, 1000)
+
+    # significant at best (p = 0), but not at worst (p = .06, corrected)
+    assert not decided[0]
+    # not significant, even if none of the splits left is extreme
+    assert decided[1]
+    # significant at best (p = .03, corrected), but not with 500 splits left
+    assert not decided[2]
+
+    n_used[0] = 1000  # no splits left
+    assert spindle_direction._is_decided(n_high, n_low, n_used, 1000)[0]
+
+
+def test_direction_pvalues_adaptive():
+    x = _random_counts(6)
+    x[0, 1:] *= 3  # region 0 leads all the other regions
+
+    with errstate(all='ignore'):
+        d = spindle_direction._calc_dir_summary(x)
+        pv_all, _ = spindle_direction._direction_pvalues(x, d, 2000,
+                                                         adaptive=False)
+        pv, n_used = spindle_direction._direction_pvalues(x, d, 2000,
+                                                          adaptive=True)
+
+    is_sign = pv < spindle_direction.P_THRESHOLD
+    assert_array_equal(is_sign, pv_all < spindle_direction.P_THRESHOLD)
+    assert is_sign.any()
+    # only the regions which are not significant stop early
+    assert_array_equal(n_used[is_sign], 2000)
+    assert n_used[~is_sign].min() < 2000
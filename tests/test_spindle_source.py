@@ -0,0 +1,54 @@
+from numpy import nan
+from numpy.random import RandomState
+from numpy.testing import assert_allclose
+
+from spgr import spindle_source
+
+
+N_CHAN = 4
+N_VERT = 30
+
+
+class FakeChan:
+    n_chan = N_CHAN
+
+    def return_label(self):
+        return ['chan{}'.format(i) for i in range(N_CHAN)]
+
+
+class FakeData:
+    def __init__(self, data, chan=None):
+        self.data = [data]
+
+
+def _dense_projection(seed_value=0):
+    """Linear and Morph as one dense matrix, NaN for the vertices far from
+    all the channels."""
+    proj = RandomState(seed_value).rand(N_VERT, N_CHAN)
+    proj[proj[:, 0] < .2, :] = nan
+    return proj
+
+
+def test_get_projection(monkeypatch, tmp_path):
+    dense = _dense_projection()
+
+    def _reflect_to_avg(subj, data, chan, to_surf):
+        return FakeData(dense.dot(data.data[0]))
+
+    (tmp_path / 'subj').mkdir()
+    monkeypatch.setattr(spindle_source, 'DATA_PATH', tmp_path)
+    monkeypatch.setattr(spindle_source, 'Data', FakeData)
+    monkeypatch.setattr(spindle_source, '_reflect_to_avg', _reflect_to_avg)
+    monkeypatch.setattr(spindle_source, 'get_chan_used_in_analysis',
+                        lambda *args, **kwargs: FakeChan())
+
+    values = RandomState(1).randn(N_CHAN, 3)
+    # the first time it's computed, then it's read from disk
+    for _ in range(2):
+        morphed = spindle_source.get_morph_linear('subj', values, 'avg')
+        assert_allclose(morphed, dense.dot(values))
+
+        morphed = spindle_source.get_morph_linear('subj', values[:, 0], 'avg')
+        assert_allclose(morphed, dense.dot(values[:, 0]))
+
+    assert len(list((tmp_path / 'subj').glob('*/*.npz'))) == 1
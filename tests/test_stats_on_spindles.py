@@ -0,0 +1,52 @@
+from numpy import arange, array, bincount, isnan, percentile, zeros
+from numpy.testing import assert_allclose, assert_array_equal
+
+from spgr import stats_on_spindles
+
+
+class FakeSpindles:
+    def __init__(self, spindle):
+        self.spindle = spindle
+
+
+def _spindle(chan, start_time, end_time):
+    return {'chan': chan, 'start_time': start_time, 'end_time': end_time}
+
+
+def test_count_cooccur_per_chan(monkeypatch):
+    time = array([arange(0, 1, .1), arange(2, 3, .1)], dtype=object)
+    chan = array([('a', 'b', 'c')], dtype=object)
+    spindles = FakeSpindles([_spindle('a', .05, .45),
+                             _spindle('b', .25, .65),
+                             _spindle('c', 2.15, 2.35),
+                             ])
+
+    monkeypatch.setattr(stats_on_spindles, 'get_spindles',
+                        lambda subj, reref, **options: spindles)
+    monkeypatch.setattr(stats_on_spindles, 'keep_time_chan',
+                        lambda subj, reref: (time, chan))
+
+    chan_prob = stats_on_spindles.count_cooccur_per_chan('subj', 'avg')
+
+    # a: .1, .2 alone, .3, .4 with b; b: .3, .4 with a, .5, .6 alone
+    assert_array_equal(chan_prob, [1.5, 1.5, 1.])
+
+
+def test_count_in_segment():
+    t_range = arange(0, 1, .1)
+
+    # start included, end excluded
+    n_sp = stats_on_spindles._count_in_segment(array([.05, .25]),
+                                                array([.45, .65]), t_range)
+    assert_array_equal(n_sp, [0, 1, 1, 2, 2, 1, 1, 0, 0, 0])
+
+
+def test_percentile_from_hist():
+    values = array([1, 1, 2, 3, 3, 3, 7])
+    hist = bincount(values)
+
+    for q in (0, 10, 25, 50, 90, 100):
+        assert_allclose(stats_on_spindles._percentile_from_hist(hist, q),
+                        percentile(values, q))
+
+    assert isnan(stats_on_spindles._percentile_from_hist(zeros(5), 10))